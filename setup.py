@@ -36,6 +36,7 @@ setup(
         'src/scripts/simpleidml_create_package_from_dir.py',
         'src/scripts/simpleidml_indesign_save_as.py',
         'src/scripts/simpleidml_indesign_close_all_documents.py',
+        'src/scripts/simpleidml_export_xml.py',
     ],
     classifiers=[
         'Environment :: Console',
@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Export the XML content of many IDML packages using a pool of processes.
+"""
+
+import argparse
+import json
+import os
+import sys
+from simple_idml.extras import export_xml_from_idml_packages, get_idml_package_filenames
+
+
+def get_output_names(sources):
+    """The name of the output file of each package: its path relative to the source directory. """
+    output_names = {}
+    for source in sources:
+        for filename in get_idml_package_filenames([source]):
+            if os.path.isdir(source):
+                name = os.path.relpath(filename, source)
+            else:
+                name = os.path.basename(filename)
+            output_names.setdefault(filename, os.path.splitext(name)[0])
+    return output_names
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('sources', metavar='SOURCE', nargs='+',
+                        help="IDML file or directory containing IDML files")
+    parser.add_argument('-w', '--workers', type=int, default=None,
+                        help="Number of processes (default: number of CPUs)")
+    parser.add_argument('--tree', action='store_true', default=False,
+                        help="Export the content as a JSON tree (export_as_tree()) instead of XML")
+    output = parser.add_mutually_exclusive_group()
+    output.add_argument('-o', '--output-dir', dest='output_dir',
+                        help="Write an .xml (or .json) file per package in this directory")
+    output.add_argument('--jsonl', default='-',
+                        help="Write a JSON Lines file, one package per line (default: stdout)")
+    args = parser.parse_args()
+
+    if args.output_dir:
+        if not os.path.exists(args.output_dir):
+            os.makedirs(args.output_dir)
+        jsonl = None
+        output_names = get_output_names(args.sources)
+        output_filenames = set()
+    elif args.jsonl == '-':
+        jsonl = sys.stdout
+    else:
+        jsonl = open(args.jsonl, mode="w", encoding="utf-8")
+
+    failures = 0
+    try:
+        for filename, result, error in export_xml_from_idml_packages(args.sources, args.workers, args.tree):
+            if error:
+                failures += 1
+                sys.stderr.write("%s: %s\n" % (filename, error))
+            if jsonl is not None:
+                line = {"filename": filename, "error": error}
+                line["tree" if args.tree else "xml"] = result
+                jsonl.write("%s\n" % json.dumps(line))
+            elif not error:
+                extension = args.tree and "json" or "xml"
+                output_filename = os.path.join(args.output_dir, "%s.%s" % (output_names[filename], extension))
+                # Two sources may hold packages with the same relative path.
+                if output_filename in output_filenames:
+                    failures += 1
+                    sys.stderr.write("%s: %s is already written by another package\n" % (filename, output_filename))
+                    continue
+                output_filenames.add(output_filename)
+                if not os.path.exists(os.path.dirname(output_filename)):
+                    os.makedirs(os.path.dirname(output_filename))
+                with open(output_filename, mode="w", encoding="utf-8") as fobj:
+                    fobj.write(args.tree and json.dumps(result) or result)
+    finally:
+        if jsonl is not None and jsonl is not sys.stdout:
+            jsonl.close()
+
+    if failures:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
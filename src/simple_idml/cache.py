@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+
+import threading
+from collections import OrderedDict
+
+
+class ParseCache(object):
+    """A LRU cache of the XML files parsed from IDML packages.
+
+    The entries are keyed by (member name, CRC32, size of the member) as read in the central
+    directory of the archive, so an unchanged file of any package opened later is not
+    parsed again. The least recently used entries are evicted when there are more than
+    `max_count' of them or when their cumulated size is more than `max_size' bytes
+    (the size of an entry being the size of its XML file).
+
+        >>> IDMLPackage.parse_cache = ParseCache(max_count=256, max_size=256 * 1024 * 1024)
+    """
+
+    def __init__(self, max_count=128, max_size=None):
+        self.max_count = max_count
+        self.max_size = max_size
+        self.size = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def get(self, key):
+        """The value stored for `key' (None if there is none). """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            self._entries.move_to_end(key)
+            return entry[0]
+
+    def set(self, key, value, size=0):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                self.size -= entry[1]
+            # An entry too big to be kept does not evict the others.
+            if self.max_size is not None and size > self.max_size:
+                return
+            self._entries[key] = (value, size)
+            self.size += size
+            while self._entries and (
+                (self.max_count is not None and len(self._entries) > self.max_count) or
+                (self.max_size is not None and self.size > self.max_size)
+            ):
+                self.size -= self._entries.popitem(last=False)[1][1]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
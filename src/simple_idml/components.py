@@ -7,7 +7,7 @@ import re
 from decimal import Decimal
 from lxml import etree
 from simple_idml import IdPkgNS, BACKINGSTORY
-from simple_idml.utils import increment_xmltag_id, prefix_content_filename
+from simple_idml.utils import get_element_signature, increment_xmltag_id, prefix_content_filename
 from simple_idml.utils import Proxy
 
 RECTO = "recto"
@@ -49,12 +49,27 @@ class IDMLXMLFile(object):
         "StrokeColor",
         "ItemLayer",
     )
+    # The DOM is kept in the parse cache of the package (see IDMLPackage.parse_cache).
+    cacheable = False
+    # Attributes looked up by get_element_by_id().
+    indexed_attrs = (
+        "Self",
+        "ParentStory",
+        "XMLContent",
+        "ItemLayer",
+    )
 
     def __init__(self, idml_package, working_copy_path=None):
         self.idml_package = idml_package
-        self.working_copy_path = working_copy_path
+        # A package in a working copy is read from it.
+        self.working_copy_path = working_copy_path or getattr(idml_package, "working_copy_path", None)
         self._fobj = None
         self._dom = None
+        self._element_index = None
+        # Modifications of the DOM when the element_index was built (see modifications).
+        self._element_index_modifications = None
+        self._modifications = 0
+        self.dirty = False
 
     def __repr__(self):
         return "<%s object %s at %s>" % (self.__class__.__name__,
@@ -65,28 +80,119 @@ class IDMLXMLFile(object):
         if self._fobj is None:
             if self.working_copy_path:
                 filename = os.path.join(self.working_copy_path, self.name)
+                # Behave like the archive when the file does not exist.
+                if not os.path.exists(filename):
+                    raise KeyError("There is no item named %r in the working copy" % self.name)
                 fobj = open(filename, mode="rb+")
             else:
                 fobj = self.idml_package.open(self.name, mode="r")
             self._fobj = fobj
         return self._fobj
 
+    def exists(self):
+        """The file is in the package (or in its working copy), checked without opening it. """
+        if self._dom is not None or self._fobj is not None:
+            return True
+        if self.working_copy_path:
+            return os.path.exists(os.path.join(self.working_copy_path, self.name))
+        try:
+            self.idml_package.getinfo(self.name)
+        except KeyError:
+            return False
+        return True
+
+    @property
+    def working_copy_doms(self):
+        """The DOMs shared by the components of a package opened in a working copy. """
+        if self.working_copy_path is None:
+            return None
+        return getattr(self.idml_package, "working_copy_doms", None)
+
+    @property
+    def shared_doms(self):
+        """The DOMs shared by the components of a package in a working copy or read-only. """
+        doms = self.working_copy_doms
+        if doms is None:
+            doms = getattr(self.idml_package, "read_only_doms", None)
+        return doms
+
+    @property
+    def working_copy_modifications(self):
+        if self.working_copy_path is None:
+            return None
+        return getattr(self.idml_package, "working_copy_modifications", None)
+
+    @property
+    def modifications(self):
+        """The number of modifications of the DOM, counted for all the components sharing it. """
+        modifications = self.working_copy_modifications
+        if modifications is None:
+            return self._modifications
+        return modifications.get(self.name, 0)
+
+    def mark_modified(self):
+        """To call when the DOM is modified: the misses of the element_index are not trusted anymore. """
+        modifications = self.working_copy_modifications
+        if modifications is None:
+            self._modifications += 1
+        else:
+            modifications[self.name] = modifications.get(self.name, 0) + 1
+
+    @property
+    def working_copy_dirty_files(self):
+        if self.working_copy_path is None:
+            return None
+        return getattr(self.idml_package, "working_copy_dirty_files", None)
+
     @property
     def dom(self):
         if self._dom is None:
-            xml = self.fobj.read()
-            try:
-                dom = etree.fromstring(xml, parser=etree.XMLParser(huge_tree=True))
-            except ValueError:
-                # Python3: when the fobj come from Story.create()
-                # it is strictly a textfile that cannot be implicitly
-                # read as a bytestring (required by etree.fromstring()).
-                dom = etree.fromstring(xml.encode('utf-8'))
+            doms = self.shared_doms
+            if doms is not None and self.name in doms:
+                self._dom = doms[self.name]
+                return self._dom
+
+            cache_key = None
+            if self.cacheable and self._fobj is None and self.working_copy_path is None:
+                cache_key = self.idml_package.get_member_cache_key(self.name)
+            dom = cache_key and self.idml_package.get_cached(cache_key)
+            if dom is None:
+                dom = self.parse(etree.XMLParser(huge_tree=True))
+                if cache_key:
+                    self.idml_package.set_cached(cache_key, dom, self.idml_package.getinfo(self.name).file_size)
             self._dom = dom
-            self._fobj.close()
-            self._fobj = None
+            if doms is not None:
+                doms[self.name] = dom
         return self._dom
 
+    def parse(self, parser):
+        """Parse the file with `parser' and return the DOM (or the result of the parser target).
+
+        A member stored uncompressed in the archive is parsed from the archive mapped in
+        memory, without reading it through a ZipExtFile. """
+        buf = None
+        if self._fobj is None and self.working_copy_path is None:
+            buf = self.idml_package.get_member_buffer(self.name)
+        if buf is not None:
+            with buf:
+                try:
+                    return etree.fromstring(buf, parser=parser)
+                except (TypeError, ValueError):
+                    # lxml < 5 only parses strings.
+                    return etree.fromstring(buf.tobytes(), parser=parser)
+
+        xml = self.fobj.read()
+        try:
+            result = etree.fromstring(xml, parser=parser)
+        except ValueError:
+            # Python3: when the fobj come from Story.create()
+            # it is strictly a textfile that cannot be implicitly
+            # read as a bytestring (required by etree.fromstring()).
+            result = etree.fromstring(xml.encode('utf-8'), parser=parser)
+        self._fobj.close()
+        self._fobj = None
+        return result
+
     def tostring(self):
         kwargs = {"xml_declaration": True,
                   "encoding": "UTF-8",
@@ -107,26 +213,92 @@ class IDMLXMLFile(object):
         return s
 
     def synchronize(self):
+        """Report the DOM modifications into the working copy.
+
+        When the package is opened in a working copy (see IDMLPackage.open_working_copy())
+        the file is only marked as dirty: it is serialized once when the package is flushed
+        or committed. """
+        self.mark_modified()
+        dirty_files = self.working_copy_dirty_files
+        if dirty_files is None:
+            self.write()
+        else:
+            self.dom
+            self.dirty = True
+            dirty_files[self.name] = self
+
+    def write(self):
+        """Write the file in the working copy. """
         # Explicit initialization of dom from self._fobj before reset
         # because in tostring() we get the dom from this file if None.
         self.dom
-        self.fobj.close()
-        self._fobj = None
+        if self._fobj is not None:
+            self._fobj.close()
+            self._fobj = None
 
         # Must instanciate with a working_copy to use this.
         fobj = open(os.path.join(self.working_copy_path, self.name), mode="wb+")
         fobj.write(self.tostring())
         fobj.close()
+        self.dirty = False
+
+    @property
+    def element_index(self):
+        """Elements of the DOM by (attribute, value) for the `indexed_attrs', in document order.
+
+        The index is not updated when the DOM is modified: an element found there must be
+        checked with is_indexed_element() and, once the DOM is marked as modified (see
+        mark_modified()), the DOM must be searched if none is found. """
+        if self._element_index is None:
+            element_index = {}
+            for elt in self.dom.iter(tag=etree.Element):
+                for attr in self.indexed_attrs:
+                    value = elt.get(attr)
+                    if value is not None:
+                        element_index.setdefault((attr, value), []).append(elt)
+            self._element_index = element_index
+            self._element_index_modifications = self.modifications
+        return self._element_index
+
+    def index_element(self, elt):
+        """Add an element inserted in the DOM to the element_index, if it is built. """
+        if self._element_index is None:
+            return
+        for attr in self.indexed_attrs:
+            value = elt.get(attr)
+            if value is not None:
+                self._element_index.setdefault((attr, value), []).insert(0, elt)
+
+    def is_indexed_element(self, elt, attr, value):
+        """The indexed element is still in the DOM with the same attribute value. """
+        if elt.get(attr) != value:
+            return False
+        root = elt
+        for root in elt.iterancestors():
+            pass
+        return root is self.dom
 
     def get_element_by_id(self, value, tag="XMLElement", attr="Self"):
-        elem = self.dom.xpath("//%s[@%s='%s']" % (tag, attr, value))
-        # etree FutureWarning when trying to simply do: elem = len(elem) and elem[0] or None
-        if len(elem):
-            elem = elem[0]
-            if elem.tag == "XMLElement":
-                elem = XMLElement(elem)
-        else:
-            elem = None
+        elem = None
+        if attr in self.indexed_attrs:
+            for elt in self.element_index.get((attr, value), []):
+                if (tag == "*" or elt.tag == tag) and self.is_indexed_element(elt, attr, value):
+                    elem = elt
+                    break
+
+        # A miss in the index is trusted unless the file was modified since it was built.
+        if elem is None and (attr not in self.indexed_attrs or
+                             self.modifications != self._element_index_modifications):
+            elems = self.dom.xpath("//%s[@%s='%s']" % (tag, attr, value))
+            # etree FutureWarning when trying to simply do: elem = len(elem) and elem[0] or None
+            if len(elems):
+                elem = elems[0]
+                # The element has been added or modified since the index was built.
+                if attr in self.indexed_attrs:
+                    self.element_index.setdefault((attr, value), []).insert(0, elem)
+
+        if elem is not None and elem.tag == "XMLElement":
+            elem = XMLElement(elem)
         return elem
 
     def prefix_references(self, prefix):
@@ -158,6 +330,8 @@ class IDMLXMLFile(object):
         if elt and elt[0].get("StoryList"):
             elt[0].set("StoryList", " ".join(["%s%s" % (prefix, s)
                                               for s in elt[0].get("StoryList").split(" ")]))
+        self._element_index = None
+        self.mark_modified()
 
     def set_element_resource_path(self, element_id, resource_path, synchronize=False):
         """ For Spread and Story subclasses only (this comment is a call for a Mixin). """
@@ -236,6 +410,10 @@ class Spread(IDMLXMLFile):
             self._node = node
         return self._node
 
+    def synchronize(self):
+        super(Spread, self).synchronize()
+        self.idml_package.invalidate_spread_index()
+
     def add_page(self, page):
         """ Spread only manage 2 pages. """
         if self.pages:
@@ -279,13 +457,20 @@ class Spread(IDMLXMLFile):
         for elt in self.dom.iter():
             if elt.get("ItemLayer"):
                 elt.set("ItemLayer", layer_id)
+        self._element_index = None
         self.synchronize()
 
     def has_any_item_on_layer(self, layer_id):
         # The page Guide are not page items.
+        for elt in self.element_index.get(("ItemLayer", layer_id), []):
+            if elt.tag != "Guide" and self.is_indexed_element(elt, "ItemLayer", layer_id):
+                return True
         return bool(len(self.node.xpath(".//*[not(self::Guide)][@ItemLayer='%s']" % layer_id)))
 
     def has_any_guide_on_layer(self, layer_id):
+        for elt in self.element_index.get(("ItemLayer", layer_id), []):
+            if elt.tag == "Guide" and self.is_indexed_element(elt, "ItemLayer", layer_id):
+                return True
         return bool(len(self.node.xpath(".//Guide[@ItemLayer='%s']" % layer_id)))
 
     def remove_guides_on_layer(self, layer_id, synchronize=False):
@@ -356,6 +541,8 @@ class Story(IDMLXMLFile):
 
         story.fobj.close()
         story._fobj = None
+        if idml_package is not None:
+            idml_package._touch_working_copy_file(story_name)
         return story
 
     @property
@@ -449,6 +636,7 @@ class Story(IDMLXMLFile):
         node = self.get_element_by_id(element_destination_id)
         node.append(element)
         self.set_element_id(element)
+        self.index_element(element)
 
     def add_content_to_element(self, element_id, content, parent=None):
         element = self.get_element_by_id(element_id)
@@ -480,6 +668,7 @@ class BackingStory(Story):
 
 class Designmap(IDMLXMLFile):
     name = "designmap.xml"
+    cacheable = True
     doctype = '<?aid style="50" type="document" readerVersion="6.0" featureSet="257" product="7.5(142)" ?>'
     page_start_attr = "PageStart"
 
@@ -549,6 +738,7 @@ class Designmap(IDMLXMLFile):
             self.spread_nodes[-1].addnext(
                 etree.Element("{%s}Spread" % IdPkgNS, src=spread.name)
             )
+            self._spread_nodes = None
 
     def prefix(self, prefix):
         self.prefix_active_layer(prefix)
@@ -618,18 +808,88 @@ class Designmap(IDMLXMLFile):
 
 class Style(IDMLXMLFile):
     name = "Resources/Styles.xml"
+    cacheable = True
 
     def __init__(self, idml_package, working_copy_path=None):
         super(Style, self).__init__(idml_package, working_copy_path)
+        self._style_index = None
 
     def get_style_node_by_name(self, style_name):
-        return self.dom.xpath(".//CharacterStyle[@Self='%s']" % style_name)[0]
+        """The <CharacterStyle> node whose `Self' is `style_name' (IndexError if none). """
+        node = self.get_element_by_id(style_name, tag="CharacterStyle")
+        if node is None:
+            raise IndexError("No CharacterStyle named '%s'." % style_name)
+        return node
 
     def style_groups(self):
         """ Groups are `RootCharacterStyleGroup', `RootParagraphStyleGroup' etc. """
         return [elt for elt in self.dom.xpath("/idPkg:Styles/*", namespaces={'idPkg': IdPkgNS})
                 if re.match(r"^.+Group$", elt.tag)]
 
+    @property
+    def style_index(self):
+        """The styles and the groups of styles by `Self'. """
+        if self._style_index is None:
+            style_index = {}
+            for group in self.style_groups():
+                for node in group.iter(tag=etree.Element):
+                    if node.get("Self"):
+                        style_index.setdefault(node.get("Self"), node)
+            self._style_index = style_index
+        return self._style_index
+
+    def referenced_style_groups(self, referenced):
+        """Copies of the style groups keeping only the styles whose `Self' or `Name' is in `referenced'. """
+        style_groups = [copy.deepcopy(group) for group in self.style_groups()]
+        for group in style_groups:
+            for elt in list(group.iter(tag=etree.Element)):
+                if elt is group or not elt.get("Self") or re.match(r"^.+Group$", elt.tag):
+                    continue
+                if elt.get("Self") not in referenced and elt.get("Name") not in referenced:
+                    elt.getparent().remove(elt)
+            # The nested groups left empty.
+            for elt in reversed(list(group.iter(tag=etree.Element))):
+                if elt is not group and re.match(r"^.+Group$", elt.tag) and \
+                        not any(child.get("Self") for child in elt.iterchildren(tag=etree.Element)):
+                    elt.getparent().remove(elt)
+        return style_groups
+
+    def add_style_groups(self, style_groups):
+        """Merge the `style_groups' of another Styles file and return the conflicting ids.
+
+        The styles (and groups) already there with the same `Self' are not added again.
+        If their definition differs, the one already there is kept and their `Self' is
+        in the returned list. """
+        conflicts = []
+        root = self.get_root()
+        for group in style_groups:
+            host_group = root.find(group.tag)
+            if host_group is None:
+                self._add_style_element(root, group)
+            else:
+                self._merge_style_group(host_group, group, conflicts)
+        return conflicts
+
+    def _merge_style_group(self, host_group, group, conflicts):
+        for elt in group.iterchildren(tag=etree.Element):
+            style_id = elt.get("Self")
+            existing = style_id and self.style_index.get(style_id)
+            if existing is None or not self.is_indexed_element(existing, "Self", style_id):
+                self._add_style_element(host_group, elt)
+            elif get_element_signature(existing) == get_element_signature(elt):
+                continue
+            elif re.match(r"^.+Group$", elt.tag) and existing.tag == elt.tag:
+                self._merge_style_group(existing, elt, conflicts)
+            else:
+                conflicts.append(style_id)
+
+    def _add_style_element(self, host, elt):
+        elt = copy.deepcopy(elt)
+        host.append(elt)
+        for node in elt.iter(tag=etree.Element):
+            if node.get("Self"):
+                self.style_index[node.get("Self")] = node
+
     def get_root(self):
         return self.dom.xpath("/idPkg:Styles", namespaces={'idPkg': IdPkgNS})[0]
 
@@ -644,6 +904,7 @@ class StyleMapping(IDMLXMLFile):
     def __init__(self, idml_package, working_copy_path=None):
         super(StyleMapping, self).__init__(idml_package, working_copy_path)
         self._character_style_mapping = None
+        self._stylenode_keys = None
 
     @property
     def fobj(self):
@@ -681,19 +942,70 @@ class StyleMapping(IDMLXMLFile):
         fobj.write(self.initial_dom)
         fobj.seek(0)
         self._fobj = fobj
+        self.idml_package._touch_working_copy_file(self.name)
 
     def iter_stylenode(self):
         for n in self.dom.xpath("//XMLImportMap"):
             yield n
 
+    @property
+    def stylenode_keys(self):
+        """The set of the (MarkupTag, MappedStyle) of the <XMLImportMap>. """
+        if self._stylenode_keys is None:
+            self._stylenode_keys = set((n.get("MarkupTag"), n.get("MappedStyle")) for n in self.iter_stylenode())
+        return self._stylenode_keys
+
     def add_stylenode(self, node):
+        """Append a copy of the <XMLImportMap> `node' unless it maps the same tag to the same style. """
+        key = (node.get("MarkupTag"), node.get("MappedStyle"))
+        if key in self.stylenode_keys:
+            return
         self.dom.append(copy.deepcopy(node))
-        self._character_style_mapping = None
+        self.stylenode_keys.add(key)
+        if self._character_style_mapping is not None:
+            self._character_style_mapping[key[0].replace("XMLTag/", "")] = key[1]
+
+    def add_stylenodes(self, nodes):
+        for node in nodes:
+            self.add_stylenode(node)
 
 
 class Graphic(IDMLXMLFile):
     name = "Resources/Graphic.xml"
 
+    def __init__(self, idml_package, working_copy_path=None):
+        super(Graphic, self).__init__(idml_package, working_copy_path)
+        self._graphic_index = None
+
+    @property
+    def graphic_index(self):
+        """The colors, inks, swatches, gradients... by `Self'. """
+        if self._graphic_index is None:
+            graphic_index = {}
+            for elt in self.dom.iterchildren(tag=etree.Element):
+                if elt.get("Self"):
+                    graphic_index.setdefault(elt.get("Self"), elt)
+            self._graphic_index = graphic_index
+        return self._graphic_index
+
+    def add_graphic_nodes(self, graphic_nodes):
+        """Append a copy of the `graphic_nodes' (of another Graphic file) and return the conflicting ids.
+
+        A node already there with the same `Self' is not added again. If its definition
+        differs, the one already there is kept and its `Self' is in the returned list. """
+        conflicts = []
+        for elt in graphic_nodes:
+            graphic_id = elt.get("Self")
+            existing = graphic_id and self.graphic_index.get(graphic_id)
+            if existing is None or not self.is_indexed_element(existing, "Self", graphic_id):
+                elt = copy.deepcopy(elt)
+                self.dom.append(elt)
+                if graphic_id:
+                    self.graphic_index[graphic_id] = elt
+            elif get_element_signature(existing) != get_element_signature(elt):
+                conflicts.append(graphic_id)
+        return conflicts
+
 
 class Preferences(IDMLXMLFile):
     name = "Resources/Preferences.xml"
@@ -701,20 +1013,71 @@ class Preferences(IDMLXMLFile):
 
 class Tags(IDMLXMLFile):
     name = "XML/Tags.xml"
+    cacheable = True
+
+    def __init__(self, idml_package, working_copy_path=None):
+        super(Tags, self).__init__(idml_package, working_copy_path)
+        self._tag_ids = None
 
     def tags(self):
         return self.dom.xpath("//XMLTag")
 
+    @property
+    def tag_ids(self):
+        """The set of the `Self' of the <XMLTag>. """
+        if self._tag_ids is None:
+            self._tag_ids = set(tag.get("Self") for tag in self.tags())
+        return self._tag_ids
+
+    def add_tags(self, tags):
+        """Append a copy of the `tags' (<XMLTag> elements) whose `Self' is not already there. """
+        root = self.get_root()
+        for tag in tags:
+            if tag.get("Self") not in self.tag_ids:
+                root.append(copy.deepcopy(tag))
+                self.tag_ids.add(tag.get("Self"))
+
     def get_root(self):
         return self.dom.xpath("/idPkg:Tags", namespaces={'idPkg': IdPkgNS})[0]
 
 
 class Fonts(IDMLXMLFile):
     name = "Resources/Fonts.xml"
+    cacheable = True
+
+    def __init__(self, idml_package, working_copy_path=None):
+        super(Fonts, self).__init__(idml_package, working_copy_path)
+        self._font_family_index = None
 
     def fonts(self):
         return self.dom.xpath("//FontFamily")
 
+    def get_font_family_key(self, font_family):
+        """The identity of a <FontFamily>: its name and the names of its fonts. """
+        return (font_family.get("Name"),
+                frozenset((font.get("Name"), font.get("PostScriptName"))
+                          for font in font_family.iterchildren("Font")))
+
+    @property
+    def font_family_index(self):
+        """The <FontFamily> elements by get_font_family_key(). """
+        if self._font_family_index is None:
+            font_family_index = {}
+            for font_family in self.fonts():
+                font_family_index.setdefault(self.get_font_family_key(font_family), font_family)
+            self._font_family_index = font_family_index
+        return self._font_family_index
+
+    def add_font_families(self, font_families):
+        """Append a copy of the `font_families' not already in the file. """
+        root = self.get_root()
+        for font_family in font_families:
+            key = self.get_font_family_key(font_family)
+            if key not in self.font_family_index:
+                font_family = copy.deepcopy(font_family)
+                root.append(font_family)
+                self.font_family_index[key] = font_family
+
     def get_root(self):
         return self.dom.xpath("/idPkg:Fonts", namespaces={'idPkg': IdPkgNS})[0]
 
@@ -979,6 +1342,266 @@ class XMLElement(Proxy):
         return etree.Element(name, **attrs)
 
 
+class XMLElementsTarget(object):
+    """A parser target materializing only the XMLElement and XMLAttribute nodes of a Story.
+
+    The elements are nested as in the Story, the other nodes being skipped. """
+    tags = ("XMLElement", "XMLAttribute")
+
+    def __init__(self):
+        self.root = etree.Element("XMLElements")
+        self.elements = {}
+        self._parents = [self.root]
+
+    def start(self, tag, attrib):
+        parent = self._parents[-1]
+        if tag in self.tags:
+            elt = etree.SubElement(parent, tag, attrib)
+            if elt.get("Self") is not None:
+                self.elements.setdefault(elt.get("Self"), elt)
+            parent = elt
+        self._parents.append(parent)
+
+    def end(self, tag):
+        self._parents.pop()
+
+    def close(self):
+        return self.root
+
+
+class XMLStructureBuilder(object):
+    """Build the XML structure of a package, as seen in the Structure panel of InDesign.
+
+    Starting at BackingStory.xml, each <XMLElement XMLContent="..."/> links to the Story
+    holding its children. A Story file is read once: either through the Story objects
+    of the package or, in `streaming' mode and if its DOM is not already loaded, with
+    a XMLElementsTarget parser. """
+    rx_xpath_step = re.compile(r"^([\w.:-]+)(?:\[(\d+)\])?$")
+
+    def __init__(self, idml_package, streaming=False):
+        self.idml_package = idml_package
+        self.streaming = streaming
+        self._streamed_roots = {}
+        self._streamed_elements = {}
+
+    def build(self, xpath=None, with_ancestors=False):
+        """The structure root node or the node at `xpath' (None if there is none).
+
+        `xpath' is a path of the structure such as `/Root/module[2]/article': only
+        the stories of the nodes along the path and under the node are read.
+        If `with_ancestors' is True, the node has its ancestors (without their other
+        children) as parents. """
+        root = self.get_root()
+        if xpath is None:
+            return self.build_node(root, root)
+        found = self.find(root, xpath)
+        if found is None:
+            return None
+        node = self.build_node(*found[-1])
+        if with_ancestors:
+            child = node
+            for source_node, children_source_node in reversed(found[:-1]):
+                parent = XMLElement(source_node).to_xml_structure_element()
+                parent.append(child)
+                child = parent
+        return node
+
+    def build_node(self, source_node, children_source_node):
+        node = XMLElement(source_node).to_xml_structure_element()
+        if children_source_node is not None:
+            for child in self.iter_children(children_source_node):
+                node.append(self.build_node(child, self.get_children_source(child)))
+        return node
+
+    def get_root(self):
+        if self.streaming and not self.is_loaded(self.idml_package.get_story_object(BACKINGSTORY)):
+            return self.get_streamed_root(BACKINGSTORY).find(".//XMLElement")
+        return self.idml_package.get_story_object(BACKINGSTORY).get_root().element
+
+    def iter_children(self, source_node):
+        """The XMLElement nodes under `source_node', skipping the other nodes. """
+        for elt in source_node.iterchildren():
+            if not elt.tag == "XMLElement":
+                for child in self.iter_children(elt):
+                    yield child
+            if elt.get("Self") == source_node.get("Self"):
+                continue
+            if not elt.get("MarkupTag"):
+                continue
+            yield elt
+
+    def get_children_source(self, source_node):
+        """The node holding the children: the node itself or its copy in another Story. """
+        xml_content = source_node.get("XMLContent")
+        if not xml_content:
+            return source_node
+        story_name = "%s/Story_%s.xml" % (STORIES_DIRNAME, xml_content)
+        try:
+            return self.get_story_element(story_name, source_node.get("Self"))
+        # The story does not exists.
+        except KeyError:
+            return None
+
+    def get_story_element(self, story_name, element_id):
+        story = self.idml_package.get_story_object(story_name)
+        if self.streaming and not self.is_loaded(story):
+            self.get_streamed_root(story_name)
+            return self._streamed_elements[story_name].get(element_id)
+        elt = story.get_element_by_id(element_id)
+        return elt.element if elt is not None else None
+
+    def get_streamed_root(self, story_name):
+        if story_name not in self._streamed_roots:
+            story = self.idml_package.get_story_object(story_name)
+            target = XMLElementsTarget()
+            try:
+                story.parse(etree.XMLParser(target=target, huge_tree=True))
+            finally:
+                if story._fobj is not None:
+                    story._fobj.close()
+                    story._fobj = None
+            self._streamed_roots[story_name] = target.root
+            self._streamed_elements[story_name] = target.elements
+        return self._streamed_roots[story_name]
+
+    def is_loaded(self, story):
+        doms = story.shared_doms
+        return story._dom is not None or (doms is not None and story.name in doms)
+
+    def find(self, root, xpath):
+        """The (node, children source node) of each step of `xpath', from the root.
+
+        Raise ValueError if `xpath' is not a simple path of the structure. """
+        steps = xpath.split("/")
+        if len(steps) < 2 or steps[0] != "":
+            raise ValueError("Unsupported structure path: %s" % xpath)
+        path = []
+        for step in steps[1:]:
+            match = self.rx_xpath_step.match(step)
+            if match is None:
+                raise ValueError("Unsupported structure path: %s" % xpath)
+            tag, position = match.group(1), int(match.group(2) or 1)
+            if not path:
+                candidates = [root]
+            else:
+                candidates = self.iter_children(path[-1][1]) if path[-1][1] is not None else []
+            found = None
+            for elt in candidates:
+                if elt.get("MarkupTag").replace("XMLTag/", "") == tag:
+                    position -= 1
+                    if position == 0:
+                        found = (elt, self.get_children_source(elt) if elt is not root else elt)
+                        break
+            if found is None:
+                return None
+            path.append(found)
+        return path
+
+
+class XMLStructureIndex(object):
+    """The nodes of a XML structure by path and by `Self', to avoid evaluating XPath expressions.
+
+    The canonical paths (as given by getpath()) are computed at once in a single pass and
+    kept up to date by append(), the structure only growing by appending nodes. The other
+    paths are evaluated. Any node found in the index is checked to still be in the structure. """
+
+    def __init__(self, tree):
+        self.tree = tree
+        self.root = tree.getroot()
+        self.nodes = {}
+        self.paths = {}
+        self.ids = {}
+        # The number of children by tag of the nodes.
+        self.counts = {}
+        self.add(self.root, tree.getpath(self.root))
+
+    def add(self, node, path):
+        """Index `node' at `path' and its descendants, in document order. """
+        pending = [(node, path)]
+        while pending:
+            node, path = pending.pop()
+            self.nodes[path] = node
+            self.paths[node] = path
+            if node.get("Self") is not None:
+                self.ids.setdefault(node.get("Self"), node)
+
+            children = list(node.iterchildren(tag=etree.Element))
+            counts = {}
+            for child in children:
+                counts[child.tag] = counts.get(child.tag, 0) + 1
+            self.counts[node] = counts
+            positions = {}
+            children_paths = []
+            for child in children:
+                positions[child.tag] = positions.get(child.tag, 0) + 1
+                children_paths.append((child, self.get_child_path(path, child, positions[child.tag],
+                                                                  counts[child.tag])))
+            pending.extend(reversed(children_paths))
+
+    def get_child_path(self, parent_path, child, position, count):
+        if not isinstance(child.tag, str) or child.tag.startswith("{"):
+            return self.tree.getpath(child)
+        if count > 1:
+            return "%s/%s[%d]" % (parent_path, child.tag, position)
+        return "%s/%s" % (parent_path, child.tag)
+
+    def append(self, parent, node):
+        """Append `node' to `parent' and index it. """
+        parent.append(node)
+        counts = self.counts.setdefault(parent, {})
+        count = counts.get(node.tag, 0) + 1
+        counts[node.tag] = count
+        parent_path = self.getpath(parent)
+        # The path of the first sibling and its descendants get a position.
+        if count == 2:
+            first = next(parent.iterchildren(tag=node.tag))
+            self.add(first, self.get_child_path(parent_path, first, 1, count))
+        self.add(node, self.get_child_path(parent_path, node, count, count))
+
+    def contains(self, node):
+        root = node
+        for root in node.iterancestors():
+            pass
+        return root is self.root
+
+    def getpath(self, node):
+        path = self.paths.get(node)
+        if path is None or not self.contains(node):
+            path = self.tree.getpath(node)
+            self.paths[node] = path
+        return path
+
+    def find(self, path):
+        """The first node at `path' or None. """
+        node = self.nodes.get(path)
+        if node is not None and self.contains(node):
+            return node
+        nodes = self.root.xpath(path)
+        if not len(nodes):
+            return None
+        node = nodes[0]
+        # Only the canonical paths are kept: the other ones may match another node
+        # once the structure has grown.
+        if self.getpath(node) == path:
+            self.nodes[path] = node
+        return node
+
+    def set_id(self, node, value):
+        """Set the `Self' of an indexed `node' to `value' and index it by this id. """
+        node.set("Self", value)
+        self.ids.setdefault(value, node)
+
+    def find_by_id(self, value):
+        node = self.ids.get(value)
+        if node is not None and node.get("Self") == value and self.contains(node):
+            return node
+        nodes = self.root.xpath("//*[@Self='%s']" % value)
+        if not len(nodes):
+            return None
+        self.ids[value] = nodes[0]
+        return nodes[0]
+
+
 def get_idml_xml_file_by_name(idml_package, name, working_copy_path=None):
     kwargs = {"idml_package": idml_package, "name": name, "working_copy_path": working_copy_path}
     dirname, basename = os.path.split(name)
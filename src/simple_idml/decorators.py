@@ -1,9 +1,5 @@
 # -*- coding: utf-8 -*-
 
-import os
-import shutil
-from tempfile import NamedTemporaryFile
-
 
 def simple_decorator(decorator):
     def new_decorator(f):
@@ -21,13 +17,11 @@ def simple_decorator(decorator):
 @simple_decorator
 def use_working_copy(view_func):
     def new_func(idml_package, *args, **kwargs):
+        # Already in a working copy (nested call or IDMLPackage.edit() session).
         if idml_package.working_copy_path is not None:
             return view_func(idml_package, *args, **kwargs)
 
-        tmp_filename = NamedTemporaryFile().name
-        idml_package.extractall(tmp_filename)
-        idml_package.working_copy_path = tmp_filename
-        idml_package.init_lazy_references()
+        idml_package.open_working_copy()
 
         if idml_package.debug:
             # In debug it is useful to have the original trace.
@@ -37,27 +31,10 @@ def use_working_copy(view_func):
             try:
                 idml_package = view_func(idml_package, *args, **kwargs)
             except BaseException as err:
-                idml_package.working_copy_path = None
+                idml_package.discard_working_copy()
                 raise err
 
         from simple_idml.idml import IDMLPackage
-        # Create a new archive from the extracted one.
-        tmp_package = IDMLPackage("%s.idml" % tmp_filename, mode="w")
-        for root, dirs, filenames in os.walk(tmp_filename):
-            for filename in filenames:
-                filename = os.path.join(root, filename)
-                arcname = filename.replace(tmp_filename, "")
-                tmp_package.write(filename, arcname)
-        tmp_package.close()
-
-        # swap working_copy with initial IDML Package.
-        new_filename = idml_package.filename
-        idml_package.close()
-        os.unlink(idml_package.filename)
-        os.rename(tmp_package.filename, new_filename)
-        shutil.rmtree(tmp_filename)
-        idml_package.working_copy_path = None
-
-        return IDMLPackage(new_filename)
+        return IDMLPackage(idml_package.commit_working_copy())
 
     return new_func
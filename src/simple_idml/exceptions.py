@@ -6,3 +6,7 @@ class InDesignSoapException(BaseException):
 
     def __str__(self):
         return repr(self._error)
+
+
+class MergeConflictWarning(UserWarning):
+    """Issued when an element of a merged package has the id of a different element. """
@@ -1,6 +1,13 @@
 # -*- coding: utf-8 -*-
 
 import os
+import shutil
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import ExitStack
+from tempfile import mkdtemp
+from lxml import etree
+from simple_idml.cache import ParseCache
 from simple_idml.idml import IDMLPackage
 
 
@@ -17,3 +24,168 @@ def create_idml_package_from_dir(src_dir, destination):
                     continue
                 package.write(os.path.join(root, filename),
                               os.path.join(root.replace(src_dir, "."), filename))
+
+
+def get_idml_package_filenames(sources):
+    """The IDML files of `sources' (filenames or directories explored recursively). """
+    filenames = []
+    for source in sources:
+        if os.path.isdir(source):
+            for root, dirs, files in os.walk(source):
+                dirs.sort()
+                filenames.extend([os.path.join(root, f) for f in sorted(files)
+                                  if os.path.splitext(f)[1].lower() == ".idml"])
+        else:
+            filenames.append(source)
+    return filenames
+
+
+def export_xml_from_idml_packages(sources, workers=None, as_tree=False, chunksize=1):
+    """Call export_xml() (or export_as_tree()) on many packages with a pool of `workers' processes.
+
+    `sources' are IDML filenames or directories. Yield (filename, result, error) in the order of
+    the files as soon as available, `error' being a message if the export of the file failed. """
+    filenames = get_idml_package_filenames(sources)
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        for result in executor.map(_export_xml_from_idml_package, filenames,
+                                   [as_tree] * len(filenames), chunksize=chunksize):
+            yield result
+
+
+def _export_xml_from_idml_package(filename, as_tree=False):
+    try:
+        with IDMLPackage(filename) as idml_package:
+            if as_tree:
+                result = idml_package.export_as_tree()
+            else:
+                result = idml_package.export_xml()
+    except Exception as err:
+        return filename, None, "%s: %s" % (err.__class__.__name__, err)
+    return filename, result, None
+
+
+def prepare_idml_packages(sources, workers=None, chunksize=1):
+    """Prefix copies of many packages and compute what is copied from them with a pool of `workers' processes.
+
+    `sources' is a list of (filename, prefix, items). Each package is copied in a temporary
+    directory and the copy is prefixed (see IDMLPackage.prefix()), then its xml_structure and
+    the resources referenced by each of its `items' are computed: a (page_number, only) pair for
+    add_pages_from_idml() or an `only' xpath for insert_idml(). Yield (filename, prefixed_filename,
+    referenced, xml_structure, error) in the order of `sources', `prefixed_filename' being the
+    prefixed copy, `referenced' the list of the resources of each item, `xml_structure' the
+    (key, serialized xml_structure) of the prefixed copy (see open_prepared_idml_package()) and
+    `error' a message if the preparation of the file failed. The caller removes the directory
+    of each prefixed copy (see remove_prepared_idml_package()). """
+    filenames, prefixes, items = zip(*sources) if sources else ((), (), ())
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        for result in executor.map(_prepare_idml_package, filenames, prefixes, items,
+                                   chunksize=chunksize):
+            yield result
+
+
+def _prepare_idml_package(filename, prefix, items):
+    tmp_dirname = mkdtemp()
+    prefixed_filename = os.path.join(tmp_dirname, os.path.basename(filename))
+    try:
+        shutil.copy2(filename, prefixed_filename)
+        with IDMLPackage(prefixed_filename) as idml_package:
+            with idml_package.prefix(prefix) as prefixed_package:
+                referenced = []
+                for item in items:
+                    if isinstance(item, tuple):
+                        referenced.append(prefixed_package.get_page_referenced_resources(*item))
+                    else:
+                        referenced.append(prefixed_package.get_insert_referenced_resources(item))
+                xml_structure = (prefixed_package.get_xml_structure_key(),
+                                 etree.tostring(prefixed_package.xml_structure))
+    except Exception as err:
+        shutil.rmtree(tmp_dirname, ignore_errors=True)
+        return filename, None, None, None, "%s: %s" % (err.__class__.__name__, err)
+    return filename, prefixed_filename, referenced, xml_structure, None
+
+
+def open_prepared_idml_package(filename, xml_structure):
+    """Open a package prepared by prepare_idml_packages() reusing the xml_structure computed there.
+
+    The xml_structure is kept in a parse_cache of the package (see IDMLPackage.parse_cache) so it
+    is used only if the story files are still the ones it was computed from. """
+    idml_package = IDMLPackage(filename)
+    idml_package.parse_cache = ParseCache(max_count=None)
+    key, content = xml_structure
+    if key is not None:
+        idml_package.set_cached(key, etree.fromstring(content), len(content))
+    return idml_package
+
+
+def remove_prepared_idml_package(prefixed_filename):
+    """Remove a prefixed copy made by prepare_idml_packages() and its temporary directory. """
+    shutil.rmtree(os.path.dirname(prefixed_filename), ignore_errors=True)
+
+
+def add_pages_from_idml_files(idml_package, pages, workers=None):
+    """add_pages_from_idml() with the source packages prepared in a pool of processes.
+
+    `pages' is a list of (filename, prefix, page_number, at, only). Prefixed copies of the files
+    are made, their xml_structure and the resources used by their pages are computed in parallel
+    (see prepare_idml_packages()), then the pages are added in order to `idml_package', which
+    is edited in place (see IDMLPackage.edit()). The source files are left untouched. """
+    prepared = _prepare_idml_files([(filename, prefix, (page_number, only))
+                                    for filename, prefix, page_number, at, only in pages], workers)
+    try:
+        with ExitStack() as stack:
+            packages = {filename: stack.enter_context(open_prepared_idml_package(prefixed_filename, xml_structure))
+                        for filename, (prefixed_filename, referenced, xml_structure) in prepared.items()}
+            idml_packages, referenced = [], []
+            for filename, prefix, page_number, at, only in pages:
+                idml_packages.append((packages[filename], page_number, at, only))
+                referenced.append(prepared[filename][1].pop(0))
+            with idml_package.edit():
+                idml_package.add_pages_from_idml(idml_packages, referenced=referenced)
+    finally:
+        for prefixed_filename, referenced, xml_structure in prepared.values():
+            remove_prepared_idml_package(prefixed_filename)
+
+
+def insert_idml_files(idml_package, insertions, workers=None):
+    """insert_idml() with the source packages prepared in a pool of processes.
+
+    `insertions' is a list of (filename, prefix, at, only). Prefixed copies of the files are
+    made, their xml_structure and the resources used by what is inserted are computed in
+    parallel (see prepare_idml_packages()), then the insertions are done in order in
+    `idml_package', which is edited in place. The source files are left untouched. """
+    prepared = _prepare_idml_files([(filename, prefix, only)
+                                    for filename, prefix, at, only in insertions], workers)
+    try:
+        with ExitStack() as stack:
+            packages = {filename: stack.enter_context(open_prepared_idml_package(prefixed_filename, xml_structure))
+                        for filename, (prefixed_filename, referenced, xml_structure) in prepared.items()}
+            with idml_package.edit():
+                for filename, prefix, at, only in insertions:
+                    idml_package.insert_idml(packages[filename], at, only,
+                                             referenced=prepared[filename][1].pop(0))
+    finally:
+        for prefixed_filename, referenced, xml_structure in prepared.values():
+            remove_prepared_idml_package(prefixed_filename)
+
+
+def _prepare_idml_files(items, workers=None):
+    """Group the (filename, prefix, item) by file, prepare them and return the (prefixed_filename, referenced, xml_structure) by file. """
+    sources = OrderedDict()
+    for filename, prefix, item in items:
+        if filename in sources and sources[filename][0] != prefix:
+            raise ValueError("%s cannot be prefixed by both %s and %s." % (filename, sources[filename][0], prefix))
+        sources.setdefault(filename, (prefix, []))[1].append(item)
+
+    prepared, errors = OrderedDict(), []
+    for filename, prefixed_filename, referenced, xml_structure, error in prepare_idml_packages(
+        [(filename, prefix, file_items) for filename, (prefix, file_items) in sources.items()], workers
+    ):
+        if error is not None:
+            errors.append("%s could not be prepared: %s" % (filename, error))
+        else:
+            prepared[filename] = (prefixed_filename, referenced, xml_structure)
+    if errors:
+        for prefixed_filename, referenced, xml_structure in prepared.values():
+            remove_prepared_idml_package(prefixed_filename)
+        raise IOError(errors[0])
+    return prepared
@@ -1,30 +1,58 @@
 # -*- coding: utf-8 -*-
 
 import copy
+import io
+import mmap
 import os
 import re
 import shutil
+import warnings
 import zipfile
+import zlib
+from collections import OrderedDict
+from contextlib import contextmanager
 from decimal import Decimal
+from tempfile import mkdtemp
 from lxml import etree
 from simple_idml import BACKINGSTORY, SETCONTENT_TAG, IGNORECONTENT_TAG, FORCECONTENT_TAG
 from simple_idml.components import get_idml_xml_file_by_name
 from simple_idml.components import (Designmap, Spread, Story, BackingStory,
-                                    Style, StyleMapping, Graphic, Tags, Fonts, XMLElement)
+                                    Style, StyleMapping, Graphic, Tags, Fonts, XMLElement,
+                                    XMLStructureBuilder, XMLStructureIndex)
 from simple_idml.decorators import use_working_copy
-from simple_idml.utils import increment_filename, prefix_content_filename, tree_to_etree_dom
+from simple_idml.exceptions import MergeConflictWarning
+from simple_idml.utils import (copy_zip_member, get_zip_member_data_offset, increment_filename,
+                               prefix_content_filename)
 
 STORIES_DIRNAME = "Stories"
 
 
 class IDMLPackage(zipfile.ZipFile):
-    """An IDML file (a package) is a Zip-stored archive/UCF container. """
+    """An IDML file (a package) is a Zip-stored archive/UCF container.
+
+    A package opened with `read_only=True' can't be modified: its components share one
+    parsed DOM per file, the lists of elements (tags, font_families...) are not copies
+    of them and no working copy is ever extracted. """
     debug = False
+    # A simple_idml.cache.ParseCache shared by the packages to not parse the same files again.
+    parse_cache = None
 
     def __init__(self, *args, **kwargs):
+        read_only = kwargs.pop("read_only", False)
         kwargs["compression"] = zipfile.ZIP_STORED
+        self._mmap = None
         zipfile.ZipFile.__init__(self, *args, **kwargs)
+        if read_only and self.mode != "r":
+            raise ValueError("A read-only package must be opened with mode 'r'.")
+        self.read_only = read_only
+        # The DOMs shared by the components of a read-only package.
+        self.read_only_doms = {} if read_only else None
         self.working_copy_path = None
+        self.working_copy_doms = None
+        self.working_copy_dirty_files = None
+        self.working_copy_touched_files = None
+        self.working_copy_modifications = None
+        self._story_objects = {}
         self.init_lazy_references()
 
     def __repr__(self):
@@ -33,11 +61,79 @@ class IDMLPackage(zipfile.ZipFile):
             hex(id(self))
         )
 
+    def close(self):
+        if self._mmap is not None:
+            try:
+                self._mmap.close()
+            except BufferError:
+                # A view of the map is still used: it is unmapped with the last one.
+                pass
+            self._mmap = None
+        zipfile.ZipFile.close(self)
+
+    @property
+    def mmap(self):
+        """The archive file mapped in memory, if opened for reading from a file (None otherwise). """
+        if self._mmap is None and self.mode == "r" and self.fp is not None:
+            try:
+                self._mmap = mmap.mmap(self.fp.fileno(), 0, access=mmap.ACCESS_READ)
+            except (AttributeError, io.UnsupportedOperation, OSError, ValueError):
+                pass
+        return self._mmap
+
+    def get_member_buffer(self, name):
+        """A memoryview of the data of the member `name' in the mapped archive.
+
+        None if the member is not in the archive, is compressed or the archive can't be mapped.
+        The CRC of the data is checked like ZipFile.read() does. """
+        if self.working_copy_path is not None:
+            return None
+        try:
+            zinfo = self.getinfo(name)
+        except KeyError:
+            return None
+        if zinfo.compress_type != zipfile.ZIP_STORED or zinfo.flag_bits & 0x01 or self.mmap is None:
+            return None
+
+        header = self._mmap[zinfo.header_offset:zinfo.header_offset + zipfile.sizeFileHeader]
+        offset = get_zip_member_data_offset(header, zinfo)
+        buf = memoryview(self._mmap)[offset:offset + zinfo.compress_size]
+        if zlib.crc32(buf) & 0xffffffff != zinfo.CRC:
+            buf.release()
+            raise zipfile.BadZipFile("Bad CRC-32 for file %r" % name)
+        return buf
+
+    def get_member_key(self, name):
+        """The (name, CRC32, size) of the member `name' in the archive (None if there is none). """
+        try:
+            zinfo = self.getinfo(name)
+        except KeyError:
+            return None
+        return (name, zinfo.CRC, zinfo.file_size)
+
+    def get_member_cache_key(self, name):
+        """The key of the member `name' in the parse_cache (None if it can't be cached). """
+        if self.parse_cache is None or self.working_copy_path is not None:
+            return None
+        return self.get_member_key(name)
+
+    def get_cached(self, key):
+        """A copy of the DOM cached for `key' (the DOM itself for a read-only package). """
+        value = self.parse_cache.get(key)
+        if value is not None and not self.read_only:
+            value = copy.deepcopy(value)
+        return value
+
+    def set_cached(self, key, value, size):
+        self.parse_cache.set(key, value if self.read_only else copy.deepcopy(value), size)
+
     def init_lazy_references(self):
         self._xml_structure = None
         self._xml_structure_tree = None
+        self._xml_structure_index = None
         self._designmap = None
         self._tags = None
+        self._fonts = None
         self._font_families = None
         self._style_groups = None
         self._style = None
@@ -45,12 +141,159 @@ class IDMLPackage(zipfile.ZipFile):
         self._graphic = None
         self._spreads = None
         self._spreads_objects = None
+        self._spread_index = None
+        self._spread_index_invalid = False
         self._last_spread = None
         self._pages = None
         self._backing_story = None
         self._stories = None
         self._story_ids = None
         self._referenced_layers = None
+        # Merged <CharacterStyleRange> by XML structure tags chain (see import_xml()).
+        self.character_style_ranges = {}
+
+    def init_spread_references(self):
+        """Reset the references to the spreads and the pages after the spreads are modified. """
+        self._spreads = None
+        self._spreads_objects = None
+        self._spread_index = None
+        self._spread_index_invalid = False
+        self._last_spread = None
+        self._pages = None
+        self._referenced_layers = None
+
+    def invalidate_spread_index(self):
+        """Called when a spread is modified (see Spread.synchronize()): the spread index
+        is rebuilt the next time an element is not found in it. """
+        self._spread_index_invalid = True
+
+    def open_working_copy(self):
+        """Extract the package in a temporary directory where the side-effect methods work. """
+        if self.read_only:
+            raise ValueError("The package %s is opened read-only." % self.filename)
+        working_copy_path = mkdtemp()
+        self.extractall(working_copy_path)
+        self.working_copy_path = working_copy_path
+        # The components of the package share their parsed DOM while the working copy is opened.
+        self.working_copy_doms = {}
+        # Modified components, serialized on flush() or commit.
+        self.working_copy_dirty_files = {}
+        # Files written in the working copy without a DOM (created, copied or renamed).
+        self.working_copy_touched_files = set()
+        # Number of modifications of the shared DOMs by name (see IDMLXMLFile.element_index).
+        self.working_copy_modifications = {}
+        self._story_objects = {}
+        self.init_lazy_references()
+
+    def commit_working_copy(self):
+        """Replace the package file by an archive of the working copy.
+
+        The package is closed and its filename is returned.
+        Only the modified files are serialized, the others are copied as stored in the
+        initial package. """
+        tmp_package = IDMLPackage("%s.idml" % self.working_copy_path, mode="w")
+        archive_namelist = set(zipfile.ZipFile.namelist(self))
+        working_copy_namelist = set(self.namelist())
+        # Keep the order of the initial package (`mimetype' must remain the first file).
+        namelist = ([f for f in zipfile.ZipFile.namelist(self) if f in working_copy_namelist] +
+                    sorted(working_copy_namelist - archive_namelist))
+        for filename in namelist:
+            if filename in self.working_copy_dirty_files:
+                tmp_package.writestr(filename, self.working_copy_dirty_files[filename].tostring())
+            elif filename in self.working_copy_touched_files or filename not in archive_namelist:
+                tmp_package.write(os.path.join(self.working_copy_path, filename), filename)
+            else:
+                copy_zip_member(self, tmp_package, self.getinfo(filename))
+        tmp_package.close()
+
+        # swap working_copy with initial IDML Package.
+        new_filename = self.filename
+        self.close()
+        os.unlink(new_filename)
+        os.rename(tmp_package.filename, new_filename)
+        self.discard_working_copy()
+        return new_filename
+
+    def discard_working_copy(self):
+        shutil.rmtree(self.working_copy_path, ignore_errors=True)
+        self.working_copy_path = None
+        self.working_copy_doms = None
+        self.working_copy_dirty_files = None
+        self.working_copy_touched_files = None
+        self.working_copy_modifications = None
+        self._story_objects = {}
+        # The components may hold the DOMs modified in the working copy.
+        self.init_lazy_references()
+
+    def flush(self, names=None):
+        """Write the modified files (or those in `names') in the working copy.
+
+        Flushing all the files also releases the Story objects kept by get_story_object(). """
+        if self.working_copy_dirty_files is None:
+            return
+        if names is None:
+            names = list(self.working_copy_dirty_files.keys())
+            self._story_objects = {}
+        for name in names:
+            idml_xml_file = self.working_copy_dirty_files.pop(name, None)
+            if idml_xml_file is not None:
+                idml_xml_file.write()
+                self.working_copy_touched_files.add(name)
+
+    @contextmanager
+    def edit(self):
+        """Apply several side-effect methods on a single working copy.
+
+        The package is extracted once, the parsed XML files are kept in memory between the calls
+        and the archive is written once when leaving the block. The side-effect methods return
+        the instance itself inside the block, which is reopened on the new archive afterwards:
+
+            >>> with idml_package.edit() as doc:
+            ...     doc.prefix("main")
+            ...     doc.import_xml(xml, at="/Root/article[1]")
+            >>> idml_package.xml_structure
+        """
+        # Nested session.
+        if self.working_copy_path is not None:
+            yield self
+            return
+
+        self.open_working_copy()
+        try:
+            yield self
+        except BaseException:
+            self.discard_working_copy()
+            raise
+        IDMLPackage.__init__(self, self.commit_working_copy())
+
+    def _rename_working_copy_file(self, old_name, new_name):
+        os.rename(os.path.join(self.working_copy_path, old_name),
+                  os.path.join(self.working_copy_path, new_name))
+        if self.working_copy_doms is None:
+            return
+        if old_name in self.working_copy_doms:
+            self.working_copy_doms[new_name] = self.working_copy_doms.pop(old_name)
+        if old_name in self._story_objects:
+            story = self._story_objects.pop(old_name)
+            story.name = new_name
+            self._story_objects[new_name] = story
+        if old_name in self.working_copy_dirty_files:
+            idml_xml_file = self.working_copy_dirty_files.pop(old_name)
+            idml_xml_file.name = new_name
+            self.working_copy_dirty_files[new_name] = idml_xml_file
+        if old_name in self.working_copy_modifications:
+            self.working_copy_modifications[new_name] = self.working_copy_modifications.pop(old_name)
+        self.working_copy_touched_files.add(new_name)
+
+    def _touch_working_copy_file(self, name):
+        """To call when a file of the working copy is written without its DOM. """
+        if self.working_copy_doms is None:
+            return
+        self.working_copy_doms.pop(name, None)
+        self.working_copy_dirty_files.pop(name, None)
+        self.working_copy_modifications.pop(name, None)
+        self._story_objects.pop(name, None)
+        self.working_copy_touched_files.add(name)
 
     def namelist(self):
         if not self.working_copy_path:
@@ -78,39 +321,49 @@ class IDMLPackage(zipfile.ZipFile):
         Starting at BackingStory.xml where the root-element is expected (because unused). """
 
         if self._xml_structure is None:
-            source_node = self.backing_story.get_root()
-            structure = source_node.to_xml_structure_element()
-
-            def append_childs(source_node, destination_node):
-                """Recursive function to discover node structure from a story to another. """
-                for elt in source_node.iterchildren():
-                    if not elt.tag == "XMLElement":
-                        append_childs(elt, destination_node)
-                    if elt.get("Self") == source_node.get("Self"):
-                        continue
-                    if not elt.get("MarkupTag"):
-                        continue
-                    elt = XMLElement(elt)
-                    new_destination_node = elt.to_xml_structure_element()
-                    destination_node.append(new_destination_node)
-                    if elt.get("XMLContent"):
-                        xml_content_value = elt.get("XMLContent")
-                        story_name = "Stories/Story_%s.xml" % xml_content_value
-                        story = Story(self, name=story_name)
-                        try:
-                            new_source_node = story.get_element_by_id(elt.get("Self"))
-                        # The story does not exists.
-                        except KeyError:
-                            continue
-                        else:
-                            append_childs(new_source_node, new_destination_node)
-                    else:
-                        append_childs(elt, new_destination_node)
-
-            append_childs(source_node, structure)
-            self._xml_structure = structure
+            cache_key = self.get_xml_structure_cache_key()
+            if cache_key is None:
+                self._xml_structure = XMLStructureBuilder(self).build()
+            else:
+                xml_structure = self.get_cached(cache_key)
+                if xml_structure is None:
+                    xml_structure = XMLStructureBuilder(self).build()
+                    self.set_cached(cache_key, xml_structure,
+                                    sum(key[2] for key in cache_key[1]))
+                self._xml_structure = xml_structure
         return self._xml_structure
 
+    def get_xml_structure_key(self):
+        """The key of the xml_structure: the keys of the story files (see get_member_key()). """
+        keys = [self.get_member_key(name) for name in [BACKINGSTORY] + sorted(self.stories)]
+        if None in keys:
+            return None
+        return ("xml_structure", tuple(keys))
+
+    def get_xml_structure_cache_key(self):
+        """The key of the xml_structure in the parse_cache (None if it can't be cached). """
+        if self.parse_cache is None or self.working_copy_path is not None:
+            return None
+        return self.get_xml_structure_key()
+
+    def get_xml_structure(self, xpath=None, streaming=True):
+        """Compute the XML structure, or only its node at `xpath', without caching it.
+
+        Only the stories along `xpath' and under its node are read and, in `streaming' mode,
+        those whose DOM is not loaded are parsed without building it (see XMLStructureBuilder).
+        `xpath' is expected to be a simple path like `/Root/module[2]/article': any other
+        XPath expression is evaluated on the whole structure.
+
+            >>> idml_package.get_xml_structure("/Root/module[1]/Story")
+            <Element Story at 0x...>
+        """
+        builder = XMLStructureBuilder(self, streaming=streaming)
+        try:
+            return builder.build(xpath)
+        except ValueError:
+            nodes = builder.build().xpath(xpath)
+            return nodes[0] if len(nodes) else None
+
     def xml_structure_pretty(self):
         return etree.tostring(self.xml_structure, pretty_print=True)
 
@@ -121,6 +374,21 @@ class IDMLPackage(zipfile.ZipFile):
             self._xml_structure_tree = xml_structure_tree
         return self._xml_structure_tree
 
+    @property
+    def xml_structure_index(self):
+        """The paths and the `Self' of the xml_structure nodes (see XMLStructureIndex). """
+        if self._xml_structure_index is None:
+            xml_structure_index = XMLStructureIndex(self.xml_structure_tree)
+            self._xml_structure_index = xml_structure_index
+        return self._xml_structure_index
+
+    def get_xml_structure_node_by_xpath(self, xpath):
+        """The first node of the xml_structure at `xpath' (IndexError if there is none). """
+        node = self.xml_structure_index.find(xpath)
+        if node is None:
+            raise IndexError("No node at path '%s' in the XML structure." % xpath)
+        return node
+
     @property
     def designmap(self):
         if self._designmap is None:
@@ -131,21 +399,34 @@ class IDMLPackage(zipfile.ZipFile):
     @property
     def tags(self):
         if self._tags is None:
-            tags = [copy.deepcopy(elt) for elt in Tags(self).tags()]
+            tags = Tags(self).tags()
+            if not self.read_only:
+                tags = [copy.deepcopy(elt) for elt in tags]
             self._tags = tags
         return self._tags
 
     @property
     def font_families(self):
         if self._font_families is None:
-            font_families = [copy.deepcopy(elt) for elt in Fonts(self).fonts()]
+            font_families = Fonts(self).fonts()
+            if not self.read_only:
+                font_families = [copy.deepcopy(elt) for elt in font_families]
             self._font_families = font_families
         return self._font_families
 
+    @property
+    def fonts(self):
+        if self._fonts is None:
+            fonts = Fonts(self, self.working_copy_path)
+            self._fonts = fonts
+        return self._fonts
+
     @property
     def style_groups(self):
         if self._style_groups is None:
-            style_groups = [copy.deepcopy(elt) for elt in Style(self).style_groups()]
+            style_groups = Style(self).style_groups()
+            if not self.read_only:
+                style_groups = [copy.deepcopy(elt) for elt in style_groups]
             self._style_groups = style_groups
         return self._style_groups
 
@@ -185,6 +466,26 @@ class IDMLPackage(zipfile.ZipFile):
             self._spreads_objects = spreads_objects
         return self._spreads_objects
 
+    @property
+    def spread_index(self):
+        """(Spread object, element) by the `Self' and `ParentStory' values of the spreads elements.
+
+        The entries are not updated on modifications: a modified spread invalidates the
+        index (see invalidate_spread_index()) and an element missing from a valid index
+        is not in the spreads. """
+        if self._spread_index is None:
+            spread_index = {}
+            for spread in self.spreads_objects:
+                for attr in ("ParentStory", "Self"):
+                    for (index_attr, value), elts in spread.element_index.items():
+                        if index_attr != attr:
+                            continue
+                        # The first spread matching wins and `Self' prevails over `ParentStory' in a spread.
+                        if value not in spread_index or spread_index[value][0] is spread:
+                            spread_index[value] = (spread, elts[0])
+            self._spread_index = spread_index
+        return self._spread_index
+
     @property
     def last_spread(self):
         if self._last_spread is None:
@@ -205,7 +506,7 @@ class IDMLPackage(zipfile.ZipFile):
     def backing_story(self):
         """The style mapping file may not be present in the archive and is created in that case. """
         if self._backing_story is None:
-            backing_story = BackingStory(self, working_copy_path=self.working_copy_path)
+            backing_story = self.get_story_object(BACKINGSTORY)
             self._backing_story = backing_story
         return self._backing_story
 
@@ -219,7 +520,7 @@ class IDMLPackage(zipfile.ZipFile):
 
     def stories_for_node(self, node_path):
         return ["%s/Story_%s.xml" % (STORIES_DIRNAME, child.get("XMLContent"))
-                for child in self.xml_structure.xpath(node_path)[0].iter()
+                for child in self.get_xml_structure_node_by_xpath(node_path).iter()
                 if child.get("XMLContent") in self.story_ids]
 
     @property
@@ -249,14 +550,19 @@ class IDMLPackage(zipfile.ZipFile):
         return self._referenced_layers
 
     @use_working_copy
-    def import_xml(self, xml, at):
-        """ Reproduce the action «Import XML» on a XML Element in InDesign® Structure. """
+    def import_xml(self, xml, at, streaming=False):
+        """ Reproduce the action «Import XML» on a XML Element in InDesign® Structure.
 
-        # Python 3 strictly require a bytestring.
-        try:
-            source_node = etree.fromstring(xml)
-        except ValueError:
-            source_node = etree.fromstring(xml.encode("utf-8"))
+        With `streaming', `xml' is a file path or a file-like object which is parsed
+        incrementally: the memory used does not depend on the number of children
+        of its root element. """
+
+        if not streaming:
+            # Python 3 strictly require a bytestring.
+            try:
+                source_node = etree.fromstring(xml)
+            except ValueError:
+                source_node = etree.fromstring(xml.encode("utf-8"))
 
         def _set_content(xpath, element_id, content, story=None):
             story = story or self.get_story_object_by_xpath(xpath)
@@ -307,14 +613,21 @@ class IDMLPackage(zipfile.ZipFile):
             Returns:
              o new_style_range_node: unbound element.
              o root_style_node
+
+            The result only depends on the tags of the node and its parents: it is kept
+            in self.character_style_ranges.
             """
+            tags = tuple([xml_structure_node.tag] + [n.tag for n in xml_structure_node.iterancestors()])
+            if tags in self.character_style_ranges:
+                new_style_range_node, root_style_node = self.character_style_ranges[tags]
+                return copy.deepcopy(new_style_range_node), root_style_node
+
             nested_styles = []
-            while(xml_structure_node is not None):
-                style_name = self.style_mapping.character_style_mapping.get(xml_structure_node.tag)
+            for tag in tags:
+                style_name = self.style_mapping.character_style_mapping.get(tag)
                 if style_name:
                     style_node = self.style.get_style_node_by_name(style_name)
                     nested_styles.insert(0, style_node)
-                xml_structure_node = xml_structure_node.getparent()
 
             # Merge the styles starting from the top parent like in a HTML document.
             root_style_node = nested_styles.pop(0)
@@ -323,7 +636,8 @@ class IDMLPackage(zipfile.ZipFile):
             for style_to_apply_node in nested_styles:
                 _apply_style(new_style_range_node, style_to_apply_node, root_style_node)
 
-            return new_style_range_node, root_style_node
+            self.character_style_ranges[tags] = (new_style_range_node, root_style_node)
+            return copy.deepcopy(new_style_range_node), root_style_node
 
         def _apply_parent_style_range(style_range_node, applied_style_node, parent):
             """Parent CharacterStyleRange must be set locally. """
@@ -345,31 +659,11 @@ class IDMLPackage(zipfile.ZipFile):
                 if attr_node is None and parent_attr_node is not None:
                     properties_element.append(copy.deepcopy(parent_attr_node))
 
-        def _move_siblings_content(at, element_id):
-            """ When new XML elements are inserted, the siblings of the initial <content> (<BR> etc) are
-                repositionned after the last <content> created.
-            """
-            story = self.get_story_object_by_xpath(at)
-            element = story.get_element_by_id(element_id)
-            content_nodes = element.get_element_content_nodes()
-            if len(content_nodes) < 2:
-                return
-
-            first_content_node = content_nodes[0]
-            last_content_node = content_nodes[-1]
-            siblings = [s for s in first_content_node.itersiblings()]
-            if not len(siblings):
-                return
-
-            for sibling in siblings:
-                last_content_node.addnext(sibling)
-            story.synchronize()
-
         def _import_new_node(source_node, at=None, element_id=None, story=None):
-            xml_structure_parent_node = self.xml_structure.find("*//*[@Self='%s']" % element_id)
+            xml_structure_parent_node = self.xml_structure_index.find_by_id(element_id)
             xml_structure_new_node = etree.Element(source_node.tag)
             # We cannot force the self._xml_structure reset by setting it at None.
-            xml_structure_parent_node.append(xml_structure_new_node)
+            self.xml_structure_index.append(xml_structure_parent_node, xml_structure_new_node)
 
             style_range_node, applied_style_node = _get_nested_style_range_node(xml_structure_new_node)
             story = story or self.get_story_object_by_xpath(at)
@@ -380,7 +674,7 @@ class IDMLPackage(zipfile.ZipFile):
             new_xml_element.add_content(source_node.text, parent, style_range_node)
             story.add_element(element_id, new_xml_element.element)
 
-            xml_structure_new_node.set("Self", new_xml_element.get("Self"))
+            self.xml_structure_index.set_id(xml_structure_new_node, new_xml_element.get("Self"))
 
             # Source may also contains some children.
             source_node_children = source_node.getchildren()
@@ -395,8 +689,11 @@ class IDMLPackage(zipfile.ZipFile):
                 story.add_content_to_element(element_id, source_node.tail, parent)
             story.synchronize()
 
-        def _import_node(source_node, at=None, element_id=None, story=None, ignorecontent_parent_flag=False):
-            element_id = element_id or self.xml_structure.xpath(at)[0].get("Self")
+        def _import_node_items(source_node, at=None, element_id=None, story=None, ignorecontent_parent_flag=False):
+            """Import the attributes and the text of `source_node'.
+
+            Return the element id and the ignorecontent flag for the children. """
+            element_id = element_id or self.get_xml_structure_node_by_xpath(at).get("Self")
             items = dict(source_node.items())
 
             forcecontent = (items.get(FORCECONTENT_TAG) == "true")
@@ -419,23 +716,28 @@ class IDMLPackage(zipfile.ZipFile):
                     local_story.remove_element(element_id, synchronize=True)
                     spread = self.get_spread_object_by_xpath(at)
                     if spread:
-                        content_id = self.xml_structure.xpath(at)[0].get("XMLContent")
+                        content_id = self.get_xml_structure_node_by_xpath(at).get("XMLContent")
                         spread.remove_page_item(content_id, synchronize=True)
                 elif "false" not in content_flags:
                     _set_content(at, element_id, source_node.text or "", story)
 
             ignorecontent = (items.get(IGNORECONTENT_TAG) == "true") or (ignorecontent_parent_flag and not forcecontent)
+            return element_id, ignorecontent
+
+        def _import_node(source_node, at=None, element_id=None, story=None, ignorecontent_parent_flag=False):
+            element_id, ignorecontent = _import_node_items(source_node, at, element_id, story,
+                                                           ignorecontent_parent_flag)
             source_node_children = source_node.getchildren()
             if len(source_node_children):
                 source_node_children_tags = [n.tag for n in source_node_children]
-                destination_node = self.xml_structure.xpath(at)[0]
+                destination_node = self.get_xml_structure_node_by_xpath(at)
                 destination_node_children = destination_node.iterchildren()
                 destination_node_children_tags = [n.tag for n in destination_node.iterchildren()]
                 # Childrens in source node (xml file) and destination node are an exact match,
                 # we can call a map() on _import_node().
                 # FIXME: what if source_node.text exists ?
                 if destination_node_children_tags == source_node_children_tags:
-                    for s, d in zip(source_node_children, [self.xml_structure_tree.getpath(c) for c in
+                    for s, d in zip(source_node_children, [self.xml_structure_index.getpath(c) for c in
                                                            destination_node.iterchildren()]):
                         _import_node(s, at=d, ignorecontent_parent_flag=ignorecontent)
 
@@ -445,16 +747,192 @@ class IDMLPackage(zipfile.ZipFile):
                     for i, source_child in enumerate(source_node_children):
                         # Source and destination match.
                         if destination_node_child is not None and source_child.tag == destination_node_child.tag:
-                            _import_node(source_child, at=self.xml_structure_tree.getpath(destination_node_child),
+                            _import_node(source_child, at=self.xml_structure_index.getpath(destination_node_child),
                                          ignorecontent_parent_flag=ignorecontent)
                             destination_node_child = next(destination_node_children, None)
                         # Source does not match destination. It is added, but only if the tag is mapped to a style.
                         elif not ignorecontent and source_child.tag in self.style_mapping.character_style_mapping.keys():
                             _import_new_node(source_child, at, element_id)
 
-                    _move_siblings_content(at, element_id)
+                    self._move_siblings_content(at, element_id)
+
+        def _iterimport_node(source, at):
+            """Like _import_node() but the children of the root element are imported one by one
+            as they are parsed, then discarded.
+
+            A child is imported when its next sibling starts (or the root ends) to get its tail. """
+            root = element_id = ignorecontent = None
+            destination_node_children = destination_node_child = source_child = None
+            exact_match = True
+            depth = 0
+
+            def _import_child(source_child, destination_node_child):
+                """Step-by-step iteration of _import_node(). Return the next destination child. """
+                if destination_node_child is not None and source_child.tag == destination_node_child.tag:
+                    _import_node(source_child, at=self.xml_structure_index.getpath(destination_node_child),
+                                 ignorecontent_parent_flag=ignorecontent)
+                    return next(destination_node_children, None), True
+                elif not ignorecontent and source_child.tag in self.style_mapping.character_style_mapping.keys():
+                    _import_new_node(source_child, at, element_id)
+                return destination_node_child, False
+
+            for event, elt in etree.iterparse(source, events=("start", "end"), huge_tree=True):
+                if event == "start":
+                    depth += 1
+                    if depth == 1:
+                        root = elt
+                    elif depth == 2:
+                        if source_child is None:
+                            element_id, ignorecontent = _import_node_items(root, at)
+                            destination_node = self.get_xml_structure_node_by_xpath(at)
+                            destination_node_children = destination_node.iterchildren()
+                            destination_node_child = next(destination_node_children, None)
+                        else:
+                            destination_node_child, matched = _import_child(source_child, destination_node_child)
+                            exact_match = exact_match and matched
+                            source_child.clear()
+                            root.remove(source_child)
+                        source_child = elt
+                    continue
+
+                depth -= 1
+                if depth == 0:
+                    if source_child is None:
+                        _import_node(root, at)
+                    else:
+                        destination_node_child, matched = _import_child(source_child, destination_node_child)
+                        exact_match = exact_match and matched
+                        # Childrens in source node and destination node are not an exact match.
+                        if not exact_match or destination_node_child is not None:
+                            self._move_siblings_content(at, element_id)
+
+        if streaming:
+            _iterimport_node(xml, at)
+        else:
+            _import_node(source_node, at)
+        return self
+
+    def _move_siblings_content(self, at, element_id):
+        """ When new XML elements are inserted, the siblings of the initial <content> (<BR> etc) are
+            repositionned after the last <content> created.
+        """
+        story = self.get_story_object_by_xpath(at)
+        element = story.get_element_by_id(element_id)
+        content_nodes = element.get_element_content_nodes()
+        if len(content_nodes) < 2:
+            return
+
+        first_content_node = content_nodes[0]
+        last_content_node = content_nodes[-1]
+        siblings = [s for s in first_content_node.itersiblings()]
+        if not len(siblings):
+            return
+
+        for sibling in siblings:
+            last_content_node.addnext(sibling)
+        story.synchronize()
+
+    def compile_import_xml(self, xml, at):
+        """Resolve once what import_xml() does on this package for the XML shape of `xml'.
+
+        The returned XMLImportPlan can be applied with import_xml_plan() on copies of the
+        package to import XML of the same shape (same tags and same import flags): only
+        the attributes and the content are taken from the new XML. The package is not
+        modified. The nodes creating new XML elements or having content flags are not
+        compiled and are imported with import_xml(). """
+        try:
+            source_node = etree.fromstring(xml)
+        except ValueError:
+            source_node = etree.fromstring(xml.encode("utf-8"))
+        positions = dict((node, i) for i, node in enumerate(source_node.iter(tag=etree.Element)))
+
+        def _compile_node(source_node, at, ignorecontent_parent_flag=False):
+            try:
+                return _compile_node_steps(source_node, at, ignorecontent_parent_flag)
+            except ValueError:
+                # import_xml() can't be given the ignorecontent flag of the parent.
+                if ignorecontent_parent_flag:
+                    raise
+                return [("import_xml", positions[source_node], at, None, None, None)]
+
+        def _compile_node_steps(source_node, at, ignorecontent_parent_flag):
+            steps = []
+            element_id = self.get_xml_structure_node_by_xpath(at).get("Self")
+            items = dict(source_node.items())
+
+            forcecontent = (items.get(FORCECONTENT_TAG) == "true")
+            if not ignorecontent_parent_flag or forcecontent:
+                content_flags = items.get(SETCONTENT_TAG, "").split(',')
+                if "remove-previous-br" in content_flags or "delete" in content_flags:
+                    raise ValueError("Content flags are not compiled.")
+                steps.append(("import", positions[source_node], at, element_id,
+                              self.get_story_by_xpath(at), "false" not in content_flags))
+
+            ignorecontent = (items.get(IGNORECONTENT_TAG) == "true") or (ignorecontent_parent_flag and not forcecontent)
+            source_node_children = source_node.getchildren()
+            if len(source_node_children):
+                destination_node = self.get_xml_structure_node_by_xpath(at)
+                destination_node_children = destination_node.iterchildren()
+                if [n.tag for n in destination_node.iterchildren()] == [n.tag for n in source_node_children]:
+                    for s, d in zip(source_node_children, [self.xml_structure_index.getpath(c) for c in
+                                                           destination_node.iterchildren()]):
+                        steps.extend(_compile_node(s, d, ignorecontent))
+                else:
+                    destination_node_child = next(destination_node_children, None)
+                    for source_child in source_node_children:
+                        if destination_node_child is not None and source_child.tag == destination_node_child.tag:
+                            steps.extend(_compile_node(source_child,
+                                                       self.xml_structure_index.getpath(destination_node_child),
+                                                       ignorecontent))
+                            destination_node_child = next(destination_node_children, None)
+                        elif not ignorecontent and source_child.tag in self.style_mapping.character_style_mapping.keys():
+                            raise ValueError("New XML elements are not compiled.")
+                    steps.append(("move_siblings_content", None, at, element_id, None, None))
+            return steps
+
+        return XMLImportPlan(at, XMLImportPlan.get_signature(source_node), _compile_node(source_node, at))
 
-        _import_node(source_node, at)
+    @use_working_copy
+    def import_xml_plan(self, plan, xml):
+        """Import `xml' as compiled in `plan' (see compile_import_xml()).
+
+        import_xml() is called if `xml' has not the shape of the plan. """
+        try:
+            source_node = etree.fromstring(xml)
+        except ValueError:
+            source_node = etree.fromstring(xml.encode("utf-8"))
+        if XMLImportPlan.get_signature(source_node) != plan.signature:
+            return self.import_xml(xml, plan.at)
+
+        nodes = list(source_node.iter(tag=etree.Element))
+        for action, index, at, element_id, story_name, set_content in plan.steps:
+            if action == "move_siblings_content":
+                self._move_siblings_content(at, element_id)
+            elif action == "import_xml":
+                self.import_xml(etree.tostring(nodes[index], with_tail=False), at)
+            else:
+                source_node = nodes[index]
+                items = dict(source_node.items())
+                if items:
+                    self.set_attributes(at, items, element_id)
+                if set_content:
+                    story = self.get_story_object(story_name)
+                    story.set_element_content(element_id, source_node.text or "")
+                    story.synchronize()
+        return self
+
+    @use_working_copy
+    def import_xml_many(self, imports):
+        """Call import_xml() for each (xml, at) of `imports', in order.
+
+        The imports share one working copy: a story modified by several of them
+        is serialized once, when the working copy is committed.
+
+            >>> idml_package.import_xml_many([("<headline>Foo</headline>", "/Root/module[1]/headline"),
+            ...                               ("<headline>Bar</headline>", "/Root/module[2]/headline")])
+        """
+        for xml, at in imports:
+            self.import_xml(xml, at)
         return self
 
     @use_working_copy
@@ -489,7 +967,7 @@ class IDMLPackage(zipfile.ZipFile):
 
     @use_working_copy
     def set_attributes(self, xpath, items, element_id=None):
-        element_id = element_id or self.xml_structure.xpath(xpath)[0].get("Self")
+        element_id = element_id or self.get_xml_structure_node_by_xpath(xpath).get("Self")
         story = self.get_story_object_by_xpath(xpath)
         story.set_element_attributes(element_id, items)
         # Image references must be updated in the page item in Spread or Story.
@@ -510,7 +988,7 @@ class IDMLPackage(zipfile.ZipFile):
         story.synchronize()
         return self
 
-    def export_as_tree(self):
+    def export_as_tree(self, from_tag=None):
         """
         tree = {
             "tag": "Root",
@@ -520,57 +998,118 @@ class IDMLPackage(zipfile.ZipFile):
         """
 
         def _export_content_as_tree(xml_structure_node):
-            content = []
-            tree = {"tag": xml_structure_node.tag,
-                    "attrs": {},
-                    "content": content}
-            # Explore the story to discover the content and the attributes.
-            xpath = self.xml_structure_tree.getpath(xml_structure_node)
-            story = self.get_story_object_by_xpath(xpath)
+            attrs, content = self._get_exported_content(xml_structure_node)
+            return {"tag": xml_structure_node.tag,
+                    "attrs": copy.deepcopy(attrs),
+                    "content": [c if self._is_exported_text(c) else _export_content_as_tree(c)
+                                for c in content]}
 
-            try:
-                story.fobj
-            except KeyError:
-                story_content_and_xmlelement_nodes = []
-            else:
-                story_node = story.get_element_by_id(xml_structure_node.get("Self"))
-                story_content_and_xmlelement_nodes = story.get_element_content_and_xmlelement_nodes(story_node)
-                # Attributes. TODO: Attributes are already known in xml_structure.
-                tree["attrs"] = copy.deepcopy(story_node.get_attributes())
-
-            xml_structure_node_children = xml_structure_node.getchildren()
-
-            if len(story_content_and_xmlelement_nodes):
-                # Leaf with content.
-                if len(xml_structure_node_children) == 0:
-                    content.append("".join([c.text or "" for c in story_content_and_xmlelement_nodes]))  # if not XMLElement
-                # Node with content.
-                else:
-                    xml_structure_child_node = xml_structure_node_children.pop(0)
-                    for story_content_node in story_content_and_xmlelement_nodes:
-                        if story_content_node.tag == "XMLElement":
-                            content.append(_export_content_as_tree(xml_structure_child_node))
-                            try:
-                                xml_structure_child_node = xml_structure_node_children.pop(0)
-                            except IndexError:
-                                xml_structure_child_node = None
-                        else:
-                            content.append(story_content_node.text)
+        xml_structure_root_node = self._get_exported_root(from_tag)
+        return _export_content_as_tree(xml_structure_root_node)
+
+    def _get_exported_root(self, from_tag=None):
+        """The structure node to export: the root or the node at the path `from_tag'.
+
+        Unless the xml_structure is already computed, only the stories along `from_tag'
+        and under its node are read. """
+        if from_tag is None:
+            return self.xml_structure
+        if self._xml_structure is not None:
+            return self.get_xml_structure_node_by_xpath(from_tag)
+        try:
+            node = XMLStructureBuilder(self).build(from_tag, with_ancestors=True)
+        except ValueError:
+            return self.get_xml_structure_node_by_xpath(from_tag)
+        if node is None:
+            raise IndexError("No node at path '%s' in the XML structure." % from_tag)
+        return node
+
+    def _get_exported_content(self, xml_structure_node):
+        """The attributes and the content of a structure node.
+
+        The content is a list of strings and of structure child nodes. """
+        content = []
+        attrs = {}
+        # Explore the story to discover the content and the attributes.
+        story = self.get_story_object_by_structure_node(xml_structure_node)
+
+        if story.exists():
+            story_node = story.get_element_by_id(xml_structure_node.get("Self"))
+            story_content_and_xmlelement_nodes = story.get_element_content_and_xmlelement_nodes(story_node)
+            # Attributes. TODO: Attributes are already known in xml_structure.
+            attrs = story_node.get_attributes()
+        else:
+            story_content_and_xmlelement_nodes = []
+
+        xml_structure_node_children = xml_structure_node.getchildren()
+
+        if len(story_content_and_xmlelement_nodes):
+            # Leaf with content.
+            if len(xml_structure_node_children) == 0:
+                content.append("".join([c.text or "" for c in story_content_and_xmlelement_nodes]))  # if not XMLElement
+            # Node with content.
             else:
-                # Node without content > `content' is fed with recursive call on childrens.
-                if len(xml_structure_node_children):
-                    content.extend(list(map(_export_content_as_tree, xml_structure_node_children)))
+                xml_structure_child_node = xml_structure_node_children.pop(0)
+                for story_content_node in story_content_and_xmlelement_nodes:
+                    if story_content_node.tag == "XMLElement":
+                        content.append(xml_structure_child_node)
+                        try:
+                            xml_structure_child_node = xml_structure_node_children.pop(0)
+                        except IndexError:
+                            xml_structure_child_node = None
+                    else:
+                        content.append(story_content_node.text)
+        else:
+            # Node without content > `content' is fed with the childrens.
+            content.extend(xml_structure_node_children)
 
-            return tree
+        return attrs, content
 
-        xml_structure_root_node = self.xml_structure
-        return _export_content_as_tree(xml_structure_root_node)
+    def _is_exported_text(self, content):
+        return content is None or isinstance(content, str)
 
     def export_xml(self, from_tag=None, encoding=None):
-        """ Reproduce the action «Export XML» on a XML Element in InDesign® Structure. """
-        tree = self.export_as_tree()
-        dom = tree_to_etree_dom(tree)
-        return etree.tostring(dom, encoding=encoding, pretty_print=True).decode("utf-8")
+        """ Reproduce the action «Export XML» on a XML Element in InDesign® Structure.
+
+        `from_tag' is the path of the exported element (default: the root), like
+        `/Root/module[2]/article': only the stories under this element are read. """
+        output = io.BytesIO()
+        self.export_xml_to_file(output, encoding=encoding, from_tag=from_tag)
+        return output.getvalue().decode("utf-8")
+
+    def export_xml_to_file(self, output, encoding=None, from_tag=None):
+        """Write the result of export_xml() into `output' (a filename or a file-like object).
+
+        The XML is written incrementally while the stories are explored, indented as
+        etree.tostring(pretty_print=True) does: not inside an element having some text. """
+
+        def _write_node(xf, xml_structure_node, level, pretty_print):
+            attrs, content = self._get_exported_content(xml_structure_node)
+            if not content:
+                xf.write(etree.Element(xml_structure_node.tag, attrs))
+                return
+            # Text, even empty, is written as-is and stops the indentation.
+            pretty_print = pretty_print and not any(self._is_exported_text(c) for c in content)
+            with xf.element(xml_structure_node.tag, attrs):
+                for c in content:
+                    if pretty_print:
+                        xf.write("\n%s" % ("  " * (level + 1)))
+                    if self._is_exported_text(c):
+                        xf.write(c or "")
+                    else:
+                        _write_node(xf, c, level + 1, pretty_print)
+                if pretty_print:
+                    xf.write("\n%s" % ("  " * level))
+
+        if isinstance(output, str):
+            with open(output, mode="wb") as fobj:
+                return self.export_xml_to_file(fobj, encoding, from_tag)
+
+        with etree.xmlfile(output, encoding=encoding) as xf:
+            if encoding is not None and encoding.lower().replace("-", "") not in ("utf8", "ascii", "usascii"):
+                xf.write_declaration()
+            _write_node(xf, self._get_exported_root(from_tag), 0, True)
+        output.write(b"\n")
 
     @use_working_copy
     def prefix(self, prefix):
@@ -597,14 +1136,15 @@ class IDMLPackage(zipfile.ZipFile):
             new_basename = prefix_content_filename(os.path.basename(filename),
                                                    prefix, "filename")
             # mv file in the new archive with the prefix.
-            old_name = os.path.join(self.working_copy_path, filename)
-            new_name = os.path.join(os.path.dirname(old_name), new_basename)
-            os.rename(old_name, new_name)
+            self._rename_working_copy_file(filename,
+                                           "%s/%s" % (os.path.dirname(filename), new_basename))
 
         # Update designmap.xml.
         self.designmap.prefix(prefix)
         self.designmap.synchronize()
 
+        # Filenames have changed.
+        self.init_lazy_references()
         return self
 
     def is_prefixed(self, prefix):
@@ -619,19 +1159,30 @@ class IDMLPackage(zipfile.ZipFile):
         return self
 
     @use_working_copy
-    def insert_idml(self, idml_package, at, only):
+    def insert_idml(self, idml_package, at, only, referenced=None):
+        """Insert the `only' node of `idml_package' and its spread elements at `at'.
+
+        Only the resources used by what is inserted are copied. `referenced' are those
+        resources if they were computed beforehand (see get_insert_referenced_resources()). """
         t = self._get_item_translation_for_insert(idml_package, at, only)
         self.remove_content(at)
-        self._add_font_families_from_idml(idml_package)
-        self._add_styles_from_idml(idml_package)
+        spread_elts = self._get_spread_elements_to_add(idml_package, only)
+        if referenced is None:
+            referenced = idml_package.get_referenced_resources(
+                self._get_insert_elements_to_add(idml_package, only, spread_elts)
+            )
+        self._add_font_families_from_idml(idml_package, referenced)
+        self._add_styles_from_idml(idml_package, referenced)
         self._add_mapped_styles_from_idml(idml_package)
-        self._add_graphics_from_idml(idml_package)
-        self._add_tags_from_idml(idml_package)
-        self._add_spread_elements_from_idml(idml_package, at, only, t)
+        self._add_graphics_from_idml(idml_package, referenced)
+        self._add_tags_from_idml(idml_package, referenced)
+        self._add_spread_elements_from_idml(idml_package, at, only, t, spread_elts)
         self._add_stories_from_idml(idml_package, at, only)
-        self._add_layers_from_idml(idml_package, at, only)
+        self._add_layers_from_idml(idml_package, at, only, referenced)
         self.remove_orphan_layers()
         self._xml_structure = None
+        self._xml_structure_tree = None
+        self._xml_structure_index = None
         return self
 
     @use_working_copy
@@ -641,7 +1192,7 @@ class IDMLPackage(zipfile.ZipFile):
             if len(node.getchildren()):
                 for child in node.iterchildren():
                     _remove_content(child)
-            xpath = self.xml_structure_tree.getpath(node)
+            xpath = self.xml_structure_index.getpath(node)
             element_content_id = self.get_element_content_id_by_xpath(xpath)
 
             story = self.get_story_object_by_xpath(xpath)
@@ -654,7 +1205,7 @@ class IDMLPackage(zipfile.ZipFile):
                 spread.remove_page_item(element_content_id, synchronize=True)
 
         try:
-            node = self.xml_structure.xpath(under)[0]
+            node = self.get_xml_structure_node_by_xpath(under)
         except IndexError:
             raise IndexError("Cannot remove content under path '%s'. Are you sure the path exists ?" % under)
 
@@ -688,38 +1239,86 @@ class IDMLPackage(zipfile.ZipFile):
                 spread.remove_guides_on_layer(layer_id, synchronize=True)
         return self
 
-    def _add_font_families_from_idml(self, idml_package):
-        # TODO Optimization. There is a linear expansion of the Fonts.xml size
-        #      as packages are merged. Do something cleaver to prune or reuse
-        #      fonts already here.
-        fonts = Fonts(self)
-        fonts.working_copy_path = self.working_copy_path
-        fonts_root_elt = fonts.get_root()
-        for font_family in idml_package.font_families:
-            fonts_root_elt.append(copy.deepcopy(font_family))
-        fonts.synchronize()
-
-    def _add_styles_from_idml(self, idml_package):
-        """Append styles to their groups or add the group in the Styles file. """
-        styles = Style(self)
-        styles.working_copy_path = self.working_copy_path
-        styles_root_elt = styles.get_root()
-        for group_to_insert in idml_package.style_groups:
-            group_host = styles_root_elt.xpath(group_to_insert.tag)
-            # Either the group exists.
-            if group_host:
-                for style_to_insert in group_to_insert.iterchildren():
-                    group_host[0].append(copy.deepcopy(style_to_insert))
-            # or not.
-            else:
-                styles_root_elt.append(copy.deepcopy(group_to_insert))
-        styles.synchronize()
+    def get_referenced_resources(self, elements):
+        """The ids and names of the styles, swatches, font families, tags and layers of the package
+        referenced by `elements', directly or through the styles and swatches they reference.
+
+        Any attribute value or text (but the text content of the stories) may be a reference. """
+        resources = {}
+        for group in self.style.style_groups():
+            for elt in group.iter(tag=etree.Element):
+                if elt.get("Self") and not re.match(r"^.+Group$", elt.tag):
+                    resources.setdefault(elt.get("Self"), []).append(elt)
+                    resources.setdefault(elt.get("Name"), []).append(elt)
+        # A spot <Ink> is referenced by the Name of its <Color>.
+        for elt in self.graphic.dom.iterchildren(tag=etree.Element):
+            for attr in ("Self", "Name"):
+                if elt.get(attr):
+                    resources.setdefault(elt.get(attr), []).append(elt)
+
+        referenced = set()
+        pending = list(elements)
+        while pending:
+            for node in pending.pop().iter(tag=etree.Element):
+                values = node.values()
+                if node.tag != "Content" and node.text and node.text.strip():
+                    values.append(node.text.strip())
+                for value in values:
+                    if value not in referenced:
+                        referenced.add(value)
+                        pending.extend(resources.get(value, []))
+        return referenced
+
+    def get_insert_referenced_resources(self, only):
+        """The resources referenced by what insert_idml() copies for the `only' node. """
+        spread_elts = self._get_spread_elements_to_add(self, only)
+        return self.get_referenced_resources(self._get_insert_elements_to_add(self, only, spread_elts))
+
+    def _get_insert_elements_to_add(self, idml_package, only, spread_elts):
+        return (spread_elts +
+                self._get_story_elements_to_add(idml_package, only) +
+                list(idml_package.style_mapping.iter_stylenode()))
+
+    def _get_story_elements_to_add(self, idml_package, only):
+        """The stories of `idml_package' added by _add_stories_from_idml() and the `only' element. """
+        story_src = idml_package.get_story_object_by_xpath(only)
+        elements = [story_src.get_element_by_id(idml_package.get_xml_structure_node_by_xpath(only).get("Self")).element]
+        elements.extend([idml_package.get_story_object(name).dom for name in idml_package.stories_for_node(only)])
+        return elements
+
+    def _add_font_families_from_idml(self, idml_package, referenced=None):
+        """Add the font families missing in the Fonts file (see Fonts.get_font_family_key()).
+
+        If `referenced' is given (see get_referenced_resources()), only the font families
+        named in it are added. """
+        font_families = idml_package.font_families
+        if referenced is not None:
+            font_families = [f for f in font_families if f.get("Name") in referenced]
+        self.fonts.add_font_families(font_families)
+        self.fonts.synchronize()
+
+    def _add_styles_from_idml(self, idml_package, referenced=None):
+        """Append the missing styles to their groups or add the group in the Styles file.
+
+        If `referenced' is given, only the styles whose id or name is in it are added.
+        A MergeConflictWarning is issued for the styles having the id of a different style
+        already there: this one is kept. """
+        if referenced is None:
+            style_groups = idml_package.style_groups
+        else:
+            style_groups = idml_package.style.referenced_style_groups(referenced)
+        conflicts = self.style.add_style_groups(style_groups)
+        for style_id in conflicts:
+            warnings.warn("The style %s of %s differs from the one of %s, which is kept." % (
+                style_id, idml_package.filename, self.filename), MergeConflictWarning)
+        self.style.synchronize()
+        self.character_style_ranges = {}
 
     def _add_mapped_styles_from_idml(self, idml_package):
         if idml_package.style_mapping:
-            for style_node in idml_package.style_mapping.iter_stylenode():
-                self.style_mapping.add_stylenode(style_node)
+            self.style_mapping.add_stylenodes(idml_package.style_mapping.iter_stylenode())
             self.style_mapping.synchronize()
+            self.character_style_ranges = {}
 
         # Update designmap.xml because it may not reference the Mapping file.
         # if self Package does not have any style mapping.
@@ -727,18 +1326,29 @@ class IDMLPackage(zipfile.ZipFile):
             self.designmap.set_style_mapping_node()
             self.designmap.synchronize()
 
-    def _add_graphics_from_idml(self, idml_package):
-        for graphic_node in idml_package.graphic.dom.iterchildren():
-            self.graphic.dom.append(copy.deepcopy(graphic_node))
+    def _add_graphics_from_idml(self, idml_package, referenced=None):
+        """Append the missing colors, inks, swatches... to the Graphic file.
+
+        If `referenced' is given, only those whose id is in it (or without id) are added.
+        A MergeConflictWarning is issued for those having the id of a different one
+        already there: this one is kept. """
+        graphic_nodes = idml_package.graphic.dom.iterchildren()
+        if referenced is not None:
+            graphic_nodes = [elt for elt in graphic_nodes
+                             if elt.get("Self") is None or elt.get("Self") in referenced]
+        conflicts = self.graphic.add_graphic_nodes(graphic_nodes)
+        for graphic_id in conflicts:
+            warnings.warn("The graphic %s of %s differs from the one of %s, which is kept." % (
+                graphic_id, idml_package.filename, self.filename), MergeConflictWarning)
         self.graphic.synchronize()
 
-    def _add_tags_from_idml(self, idml_package):
+    def _add_tags_from_idml(self, idml_package, referenced=None):
         tags = Tags(self)
-        tags.working_copy_path = self.working_copy_path
-        tags_root_elt = tags.get_root()
-        for tag in idml_package.tags:
-            if not tags_root_elt.xpath("//XMLTag[@Self='%s']" % (tag.get("Self"))):
-                tags_root_elt.append(copy.deepcopy(tag))
+        # The tags of `idml_package' are copied only if they are missing (and referenced).
+        tags_to_add = Tags(idml_package).tags()
+        if referenced is not None:
+            tags_to_add = [tag for tag in tags_to_add if tag.get("Self") in referenced]
+        tags.add_tags(tags_to_add)
         tags.synchronize()
 
     def _get_item_translation_for_insert(self, idml_package, at, only):
@@ -769,14 +1379,30 @@ class IDMLPackage(zipfile.ZipFile):
         item_transform[5] = str(Decimal(item_transform[5]) + translation_y)
         element.set("ItemTransform", " ".join(item_transform))
 
-    def _add_spread_elements_from_idml(self, idml_package, at, only, translation):
+    def _add_spread_elements_from_idml(self, idml_package, at, only, translation, spread_elts_to_add=None):
         """ Append idml_package spread elements into self.spread[0] <Spread> node. """
 
         spread_dest_filename = self.get_spread_by_xpath(at)
         spread_dest = Spread(self, spread_dest_filename, self.working_copy_path)
         spread_dest_elt = spread_dest.dom.xpath("./Spread")[0]
 
-        only_node = idml_package.xml_structure.xpath(only)[0]
+        if spread_elts_to_add is None:
+            spread_elts_to_add = self._get_spread_elements_to_add(idml_package, only)
+
+        def _add_spread_element(spread_dest_elt, spread_elt):
+            spread_elt_copy = copy.deepcopy(spread_elt)
+            self.apply_translation_to_element(spread_elt_copy, translation)
+            spread_dest_elt.append(spread_elt_copy)
+
+        for elt in spread_elts_to_add:
+            _add_spread_element(spread_dest_elt, elt)
+
+        spread_dest.synchronize()
+        self.init_lazy_references()
+
+    def _get_spread_elements_to_add(self, idml_package, only):
+        """The spread elements of idml_package inserted with the `only' node. """
+        only_node = idml_package.get_xml_structure_node_by_xpath(only)
 
         # Add spread elements on the same layer. We start by that because the order in the
         # Spread file is the z-position on the Layer.
@@ -794,19 +1420,9 @@ class IDMLPackage(zipfile.ZipFile):
                 spread_elt = spread_elt.getparent()
             if spread_elt not in spread_elts_to_add:
                 spread_elts_to_add.append(spread_elt)
+        return spread_elts_to_add
 
-        def _add_spread_element(spread_dest_elt, spread_elt):
-            spread_elt_copy = copy.deepcopy(spread_elt)
-            self.apply_translation_to_element(spread_elt_copy, translation)
-            spread_dest_elt.append(spread_elt_copy)
-
-        for elt in spread_elts_to_add:
-            _add_spread_element(spread_dest_elt, elt)
-
-        spread_dest.synchronize()
-        self.init_lazy_references()
-
-    def _add_stories_from_idml(self, idml_package, at, only):
+    def _add_stories_from_idml(self, idml_package, at, only, reset_references=True):
         """Add all idml_package stories and insert `only' refence at `at' position in self.
 
         What we have:
@@ -841,14 +1457,16 @@ class IDMLPackage(zipfile.ZipFile):
         o The Spread page item 'udd' is updated.
         o The designmap.xml file is updated.
 
+        Unless `reset_references' is True, the xml_structure is updated in place
+        and only the references to the stories are reset.
         """
 
-        xml_element_src_id = idml_package.xml_structure.xpath(only)[0].get("Self")
+        xml_element_src_id = idml_package.get_xml_structure_node_by_xpath(only).get("Self")
         story_src_filename = idml_package.get_story_by_xpath(only)
-        story_src = Story(idml_package, story_src_filename)
+        story_src = idml_package.get_story_object(story_src_filename)
         story_src_elt = story_src.get_element_by_id(xml_element_src_id).element
 
-        xml_element_dest = self.xml_structure.xpath(at)[0]
+        xml_element_dest = self.get_xml_structure_node_by_xpath(at)
         xml_element_dest_id = xml_element_dest.get("Self")
         content_ref = xml_element_dest.get("XMLContent")
 
@@ -858,10 +1476,11 @@ class IDMLPackage(zipfile.ZipFile):
         if content_ref and (content_ref not in self.story_ids):
             self.add_story_with_content(content_ref, xml_element_dest_id, xml_element_dest.tag)
             self.xml_element_leaf_to_node(at, content_ref)
-            xml_element_dest = self.xml_structure.xpath(at)[0]
+            self.init_spread_references()
+            xml_element_dest = self.get_xml_structure_node_by_xpath(at)
 
         story_dest_filename = self.get_story_by_xpath(at)
-        story_dest = Story(self, story_dest_filename, self.working_copy_path)
+        story_dest = self.get_story_object(story_dest_filename)
         story_dest_elt = story_dest.get_element_by_id(xml_element_dest_id)
 
         story_src_elt_copy = copy.copy(story_src_elt)
@@ -870,6 +1489,9 @@ class IDMLPackage(zipfile.ZipFile):
                 story_src_elt_copy.remove(child)
         story_dest_elt.append(story_src_elt_copy)
         story_dest.synchronize()
+        if not reset_references:
+            self.xml_structure_index.append(xml_element_dest,
+                                            copy.deepcopy(idml_package.get_xml_structure_node_by_xpath(only)))
 
         # Add Story files.
         # `Stories' directory may not be present in the destination package.
@@ -880,40 +1502,86 @@ class IDMLPackage(zipfile.ZipFile):
             story_cp = open(os.path.join(self.working_copy_path, filename), mode="wb+")
             story_cp.write(idml_package.open(filename, mode="r").read())
             story_cp.close()
+            self._touch_working_copy_file(filename)
 
         # Update designmap.xml.
         self.designmap.add_stories(idml_package.story_ids_for_node(only))
         self.designmap.synchronize()
         # BackingStory.xml ??
-        self.init_lazy_references()
-
-    def _add_layers_from_idml(self, idml_package, at, only):
-        self.designmap.add_layer_nodes(idml_package.designmap.layer_nodes)
+        if reset_references:
+            self.init_lazy_references()
+        else:
+            self._stories = None
+            self._story_ids = None
+
+    def _add_layers_from_idml(self, idml_package, at, only, referenced=None):
+        layer_nodes = idml_package.designmap.layer_nodes
+        if referenced is not None:
+            layer_nodes = [layer for layer in layer_nodes if layer.get("Self") in referenced]
+        self.designmap.add_layer_nodes(layer_nodes)
         self.designmap.synchronize()
 
     @use_working_copy
-    def add_pages_from_idml(self, idml_packages):
-        for package, page_number, at, only in idml_packages:
-            self = self.add_page_from_idml(package, page_number, at, only)
+    def add_pages_from_idml(self, idml_packages, referenced=None):
+        """Add the pages of several packages: a list of (package, page_number, at, only).
+
+        The pages are added in order but the resources (fonts, styles, swatches and tags)
+        referenced by the pages of a same package are merged once for all of them.
+        `referenced' is the list of the resources referenced by each page if they were
+        computed beforehand (see get_page_referenced_resources()). """
+        resources_by_package = OrderedDict()
+        for index, (package, page_number, at, only) in enumerate(idml_packages):
+            if referenced is None:
+                resources = resources_by_package.setdefault(package, [])
+                resources.extend(self._get_page_elements_to_add(package, page_number, only))
+            else:
+                resources = resources_by_package.setdefault(package, set())
+                resources.update(referenced[index])
+            self._add_page_from_idml(package, page_number, at, only)
+        # The xml_structure updated page after page is rebuilt once.
+        self.init_lazy_references()
+
+        for package, resources in resources_by_package.items():
+            if referenced is None:
+                resources = package.get_referenced_resources(resources)
+            self._add_referenced_resources_from_idml(package, resources)
         return self
 
     @use_working_copy
     def add_page_from_idml(self, idml_package, page_number, at, only):
+        # Only the resources used by the page and its stories are copied.
+        referenced = idml_package.get_page_referenced_resources(page_number, only)
+        self._add_page_from_idml(idml_package, page_number, at, only)
+        self.init_lazy_references()
+        self._add_referenced_resources_from_idml(idml_package, referenced)
+        return self
+
+    def get_page_referenced_resources(self, page_number, only):
+        """The resources referenced by the page and the `only' node copied by add_page_from_idml(). """
+        return self.get_referenced_resources(self._get_page_elements_to_add(self, page_number, only))
+
+    def _get_page_elements_to_add(self, idml_package, page_number, only):
+        page = idml_package.pages[page_number - 1]
+        return [page.node] + page.page_items + self._get_story_elements_to_add(idml_package, only)
+
+    def _add_page_from_idml(self, idml_package, page_number, at, only):
+        """Add the page and its stories, resetting only the spread and story references. """
         last_spread = self.last_spread
         if last_spread.pages[-1].is_recto:
             last_spread = self.add_new_spread(self.working_copy_path)
 
         page = idml_package.pages[page_number - 1]
         last_spread.add_page(page)
-        self.init_lazy_references()
+        self.init_spread_references()
         last_spread.synchronize()
 
-        self._add_stories_from_idml(idml_package, at, only)
-        self._add_font_families_from_idml(idml_package)
-        self._add_styles_from_idml(idml_package)
-        self._add_tags_from_idml(idml_package)
+        self._add_stories_from_idml(idml_package, at, only, reset_references=False)
 
-        return self
+    def _add_referenced_resources_from_idml(self, idml_package, referenced):
+        self._add_font_families_from_idml(idml_package, referenced)
+        self._add_styles_from_idml(idml_package, referenced)
+        self._add_graphics_from_idml(idml_package, referenced)
+        self._add_tags_from_idml(idml_package, referenced)
 
     @use_working_copy
     def add_story_with_content(self, story_id, xml_element_id, xml_element_tag):
@@ -925,7 +1593,7 @@ class IDMLPackage(zipfile.ZipFile):
 
     @use_working_copy
     def add_note(self, note, author, at, when=None):
-        element_id = self.xml_structure.xpath(at)[0].get("Self")
+        element_id = self.get_xml_structure_node_by_xpath(at).get("Self")
         story = self.get_story_object_by_xpath(at)
         story.add_note(element_id, note, author, when)
         story.synchronize()
@@ -964,10 +1632,13 @@ class IDMLPackage(zipfile.ZipFile):
         # TODO : make sure the filename does not exists.
         new_spread_name = increment_filename(self.last_spread.name)
         new_spread_wc_path = os.path.join(working_copy_path, new_spread_name)
+        # The last spread may have been modified in memory only.
+        self.flush([self.last_spread.name])
         shutil.copy2(
             os.path.join(working_copy_path, self.last_spread.name),
             new_spread_wc_path
         )
+        self._touch_working_copy_file(new_spread_name)
         self._spreads = None
         self._spreads_objects = None
         self._last_spread = None
@@ -999,7 +1670,7 @@ class IDMLPackage(zipfile.ZipFile):
         return next(filter(lambda s: s.name == name, self.spreads_objects))
 
     def get_spread_object_by_xpath(self, xpath):
-        elt_id = self.xml_structure.xpath(xpath)[0].get("XMLContent")
+        elt_id = self.get_xml_structure_node_by_xpath(xpath).get("XMLContent")
         return self.get_spread_object_by_id(elt_id)
 
     def get_spread_object_by_id(self, elt_id):
@@ -1007,22 +1678,30 @@ class IDMLPackage(zipfile.ZipFile):
 
         Spread element matches Story's one with the ParentStory or the Self attribute value."""
 
-        result = None
-        for spread in self.spreads_objects:
+        if elt_id is None:
+            return None
+
+        spread = self._get_indexed_spread_object(elt_id)
+        if spread is None and self._spread_index_invalid:
+            # The element may have been added or modified since the index was built.
+            self.init_spread_references()
+            spread = self._get_indexed_spread_object(elt_id)
+        return spread
+
+    def _get_indexed_spread_object(self, elt_id):
+        if elt_id in self.spread_index:
+            spread, elt = self.spread_index[elt_id]
             if (
-                spread.get_element_by_id(elt_id, tag="*") is not None or
-                spread.get_element_by_id(elt_id, tag="*", attr="ParentStory") is not None
+                spread.is_indexed_element(elt, "Self", elt_id) or
+                spread.is_indexed_element(elt, "ParentStory", elt_id)
             ):
-                result = spread
-            # FIXME: That's ugly. return spread here ?
-            if result:
-                break
-        return result
+                return spread
+        return None
 
     def get_spread_elem_by_xpath(self, xpath):
         """Return the spread etree.Element matching the xml_structure's xpath. """
         spread = self.get_spread_object_by_xpath(xpath)
-        elt_id = self.xml_structure.xpath(xpath)[0].get("XMLContent")
+        elt_id = self.get_xml_structure_node_by_xpath(xpath).get("XMLContent")
         elt = spread.get_element_by_id(elt_id, tag="*")
         if elt is None:
             elt = spread.get_element_by_id(elt_id, tag="*", attr="ParentStory")
@@ -1055,7 +1734,10 @@ class IDMLPackage(zipfile.ZipFile):
             self.get_spread_element_layer_id(spread_element.getparent())
 
     def get_story_object_by_xpath(self, xpath):
-        xml_element = self.xml_structure.xpath(xpath)[0]
+        return self.get_story_object_by_structure_node(self.get_xml_structure_node_by_xpath(xpath))
+
+    def get_story_object_by_structure_node(self, xml_element):
+        """The Story object of a node of the XML structure (or of a part of it having its ancestors). """
 
         def get_story_name(xml_element):
             ref = xml_element.get("XMLContent")
@@ -1073,14 +1755,26 @@ class IDMLPackage(zipfile.ZipFile):
         # Some XMLElement store a reference which is not a Story.
         # In that case, the Story is the parent's Story.
         if (story_name not in self.story_ids) and (story_name is not BACKINGSTORY):
-            xpath = self.xml_structure_tree.getpath(xml_element.getparent())
-            story = self.get_story_object_by_xpath(xpath)
+            story = self.get_story_object_by_structure_node(xml_element.getparent())
         else:
             if story_name == BACKINGSTORY:
+                story = self.get_story_object(BACKINGSTORY)
+            else:
+                story = self.get_story_object("%s/Story_%s.xml" % (STORIES_DIRNAME, story_name))
+        return story
+
+    def get_story_object(self, name):
+        """The Story object (or the BackingStory) of the file `name'.
+
+        The same instance is returned for the lifetime of the package or of the working copy
+        so a Story file is parsed once. """
+        story = self._story_objects.get(name)
+        if story is None:
+            if name == BACKINGSTORY:
                 story = BackingStory(self)
             else:
-                story = Story(self, "%s/Story_%s.xml" % (STORIES_DIRNAME, story_name))
-        story.working_copy_path = self.working_copy_path
+                story = Story(self, name)
+            self._story_objects[name] = story
         return story
 
     def get_story_by_xpath(self, xpath):
@@ -1088,7 +1782,7 @@ class IDMLPackage(zipfile.ZipFile):
         return story and story.name or None
 
     def get_element_content_id_by_xpath(self, xpath):
-        return self.xml_structure.xpath(xpath)[0].get("XMLContent")
+        return self.get_xml_structure_node_by_xpath(xpath).get("XMLContent")
 
     def get_elem_point_position(self, elem, point_index=0):
         point = elem.xpath("Properties/PathGeometry/GeometryPathType/PathPointArray/PathPointType")[point_index]
@@ -1098,3 +1792,20 @@ class IDMLPackage(zipfile.ZipFile):
     def get_elem_translation(self, elem):
         item_transform = elem.get("ItemTransform").split(" ")
         return Decimal(item_transform[4]), Decimal(item_transform[5])
+
+
+class XMLImportPlan(object):
+    """The operations of import_xml() for a XML shape on a package (see IDMLPackage.compile_import_xml()). """
+    flags = (SETCONTENT_TAG, IGNORECONTENT_TAG, FORCECONTENT_TAG)
+
+    def __init__(self, at, signature, steps):
+        self.at = at
+        self.signature = signature
+        self.steps = steps
+
+    @classmethod
+    def get_signature(cls, source_node):
+        """The paths and the import flags of the nodes of `source_node'. """
+        tree = etree.ElementTree(source_node)
+        return [(tree.getpath(node), tuple(node.get(flag) for flag in cls.flags))
+                for node in source_node.iter(tag=etree.Element)]
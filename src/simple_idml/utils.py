@@ -3,6 +3,8 @@
 import copy
 import os
 import re
+import struct
+import zipfile
 from lxml import etree
 
 rx_numbered = re.compile(r"(.*?)(\d+)")
@@ -114,8 +116,62 @@ def etree_dom_to_tree(dom, strip_text=False):
     }
 
 
+def get_element_signature(element):
+    """A hashable representation of `element' and its descendants, ignoring the whitespaces
+    around the texts (the indentation). """
+    return (element.tag,
+            tuple(sorted(element.attrib.items())),
+            (element.text or "").strip(),
+            (element.tail or "").strip(),
+            tuple(get_element_signature(elt) for elt in element.iterchildren()))
+
+
 def deepcopy_element_as(element, tag):
     new_element = etree.Element(tag, **element.attrib)
     for child in element.iterchildren():
         new_element.append(copy.deepcopy(child))
     return new_element
+
+
+def get_zip_member_data_offset(header, zinfo):
+    """The offset of the data of the `zinfo' member in its archive, `header' being the
+    zipfile.sizeFileHeader bytes of its local header (read at zinfo.header_offset). """
+    if header[0:4] != zipfile.stringFileHeader:
+        raise zipfile.BadZipFile("Bad magic number for file header")
+    # Names and extra fields of the local header may differ from the central directory ones.
+    filename_length, extra_length = struct.unpack("<HH", header[26:30])
+    return zinfo.header_offset + zipfile.sizeFileHeader + filename_length + extra_length
+
+
+def copy_zip_member(source, destination, zinfo):
+    """Copy the `zinfo' member of the `source' ZipFile into `destination' as it is stored.
+
+    The data is neither uncompressed nor checked. """
+    # ZipFile has no public API to copy a member without recompressing it so its private
+    # attributes are used when they are there, otherwise the member is read and written again.
+    if not (
+        all(hasattr(source, attr) for attr in ("_lock", "fp")) and
+        all(hasattr(destination, attr) for attr in ("_lock", "fp", "_writecheck", "start_dir", "_didModify")) and
+        not getattr(destination, "_writing", False)
+    ):
+        destination.writestr(copy.copy(zinfo), source.read(zinfo))
+        return
+
+    with source._lock:
+        source.fp.seek(zinfo.header_offset)
+        source.fp.seek(get_zip_member_data_offset(source.fp.read(zipfile.sizeFileHeader), zinfo))
+        data = source.fp.read(zinfo.compress_size)
+
+    new_zinfo = copy.copy(zinfo)
+    # Sizes and CRC are known so they are written in the header rather in a data descriptor.
+    new_zinfo.flag_bits &= ~0x08
+    with destination._lock:
+        destination._writecheck(new_zinfo)
+        destination.fp.seek(destination.start_dir)
+        new_zinfo.header_offset = destination.fp.tell()
+        destination.fp.write(new_zinfo.FileHeader())
+        destination.fp.write(data)
+        destination.start_dir = destination.fp.tell()
+        destination.filelist.append(new_zinfo)
+        destination.NameToInfo[new_zinfo.filename] = new_zinfo
+        destination._didModify = True
@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+
+import os
+import unittest
+from lxml import etree
+from simple_idml.cache import ParseCache
+from simple_idml.components import Tags
+from simple_idml.idml import IDMLPackage
+
+CURRENT_DIR = os.path.dirname(__file__)
+IDMLFILES_DIR = os.path.join(CURRENT_DIR, "IDML")
+
+
+class ParseCacheTestCase(unittest.TestCase):
+    def tearDown(self):
+        IDMLPackage.parse_cache = None
+        super(ParseCacheTestCase, self).tearDown()
+
+    def test_eviction(self):
+        cache = ParseCache(max_count=2)
+        cache.set("a", 1, 10)
+        cache.set("b", 2, 10)
+        self.assertEqual(cache.get("a"), 1)
+        # `b' is the least recently used.
+        cache.set("c", 3, 10)
+        self.assertEqual((len(cache), cache.size), (2, 20))
+        self.assertFalse("b" in cache)
+        self.assertEqual(cache.get("b"), None)
+
+        cache = ParseCache(max_count=None, max_size=25)
+        cache.set("a", 1, 10)
+        cache.set("b", 2, 10)
+        cache.set("a", 1, 12)
+        self.assertEqual((len(cache), cache.size), (2, 22))
+        cache.set("c", 3, 10)
+        self.assertEqual((len(cache), cache.size), (2, 22))
+        self.assertFalse("b" in cache)
+        # Too big to be kept, the other entries remain.
+        cache.set("d", 4, 30)
+        self.assertEqual((len(cache), cache.size), (2, 22))
+        self.assertFalse("d" in cache)
+        # An entry replaced by a too big value is removed.
+        cache.set("a", 1, 30)
+        self.assertEqual((len(cache), cache.size), (1, 10))
+        cache.set("e", 5, 10)
+        cache.clear()
+        self.assertEqual((len(cache), cache.size), (0, 0))
+
+    def test_package_parse_cache(self):
+        IDMLPackage.parse_cache = ParseCache()
+        idml_filename = os.path.join(IDMLFILES_DIR, "article-1photo_import-xml.idml")
+        with IDMLPackage(idml_filename) as idml_file:
+            tags_info = idml_file.getinfo("XML/Tags.xml")
+            tags_key = ("XML/Tags.xml", tags_info.CRC, tags_info.file_size)
+            tags = Tags(idml_file).dom
+            idml_file.designmap.dom
+            xml_structure = idml_file.xml_structure
+            xml = idml_file.export_xml()
+        self.assertTrue(tags_key in IDMLPackage.parse_cache)
+        # designmap, Tags and the XML structure.
+        self.assertEqual(len(IDMLPackage.parse_cache), 3)
+
+        with IDMLPackage(idml_filename) as idml_file:
+            # A copy of the cached DOM.
+            self.assertEqual(etree.tostring(Tags(idml_file).dom), etree.tostring(tags))
+            self.assertFalse(Tags(idml_file).dom is IDMLPackage.parse_cache.get(tags_key))
+            self.assertEqual(etree.tostring(idml_file.xml_structure), etree.tostring(xml_structure))
+            self.assertEqual(idml_file.export_xml(), xml)
+
+        # The packages opened read-only share the cached DOM.
+        with IDMLPackage(idml_filename, read_only=True) as idml_file:
+            self.assertTrue(Tags(idml_file).dom is IDMLPackage.parse_cache.get(tags_key))
+
+
+def suite():
+    suite = unittest.TestLoader().loadTestsFromTestCase(ParseCacheTestCase)
+    return suite
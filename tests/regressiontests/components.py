@@ -6,7 +6,7 @@ import unittest
 from decimal import Decimal
 from lxml import etree
 from simple_idml.components import RECTO, VERSO
-from simple_idml.components import Spread, Story, Style, StyleMapping, XMLElement
+from simple_idml.components import Spread, Story, Style, StyleMapping, Tags, XMLElement, XMLStructureIndex
 from simple_idml.idml import IDMLPackage
 from simple_idml.test import SimpleTestCase
 from simple_idml.utils import etree_dom_to_tree
@@ -202,6 +202,20 @@ class StoryTestCase(SimpleTestCase):
         story = Story(idml_file, stories[0])
         self.assertEqual(story.node.tag, "Story")
 
+    def test_exists(self):
+        idml_file = IDMLPackage(os.path.join(IDMLFILES_DIR, "4-pages.idml"), mode="r")
+        story = Story(idml_file, "Stories/Story_ue4.xml")
+        self.assertTrue(story.exists())
+        self.assertTrue(story._fobj is None)
+        self.assertFalse(Story(idml_file, "Stories/Story_foo.xml").exists())
+
+        idml_file.open_working_copy()
+        try:
+            self.assertTrue(Story(idml_file, "Stories/Story_ue4.xml").exists())
+            self.assertFalse(Story(idml_file, "Stories/Story_foo.xml").exists())
+        finally:
+            idml_file.discard_working_copy()
+
     def test_get_element_by_id(self):
         idml_file = IDMLPackage(os.path.join(IDMLFILES_DIR, "4-pages.idml"), mode="r")
         stories = idml_file.stories
@@ -212,6 +226,44 @@ class StoryTestCase(SimpleTestCase):
         elem = story.get_element_by_id("di2i3i2", tag="*")
         self.assertEqual(elem.get("MarkupTag"), "XMLTag/content")
 
+    def test_element_index(self):
+        idml_file = IDMLPackage(os.path.join(IDMLFILES_DIR, "4-pages.idml"), mode="r")
+        story = Story(idml_file, "Stories/Story_ue4.xml")
+        self.assertEqual([e.get("MarkupTag") for e in story.element_index[("Self", "di2i3i1i1")]],
+                         ["XMLTag/title"])
+        self.assertEqual([e.get("Self") for e in story.element_index[("XMLContent", "ue4")]],
+                         ["di2i3i1"])
+
+        # The index is not fooled by the modifications of the DOM.
+        title = story.get_element_by_id("di2i3i1i1")
+        title.getparent().remove(title.element)
+        self.assertEqual(story.get_element_by_id("di2i3i1i1"), None)
+
+        subtitle = story.get_element_by_id("di2i3i1i2")
+        subtitle.set("Self", "di2i3i1i3")
+        self.assertEqual(story.get_element_by_id("di2i3i1i2"), None)
+        # A miss is trusted until the file is marked as modified (see synchronize()).
+        self.assertEqual(story.get_element_by_id("di2i3i1i3"), None)
+        story.mark_modified()
+        self.assertEqual(story.get_element_by_id("di2i3i1i3").get("MarkupTag"), "XMLTag/subtitle")
+
+        new_element = etree.Element("XMLElement", MarkupTag="XMLTag/title")
+        story.add_element("di2i3i1", new_element)
+        self.assertEqual(new_element.get("Self"), "di2i3i1i1")
+        self.assertEqual(story.get_element_by_id("di2i3i1i1").element, new_element)
+
+        # In a working copy, the modifications are counted for all the components sharing the DOM.
+        idml_file.open_working_copy()
+        try:
+            story = Story(idml_file, "Stories/Story_ue4.xml")
+            self.assertEqual(story.get_element_by_id("di2i3i1i3"), None)
+            other_story = Story(idml_file, "Stories/Story_ue4.xml")
+            other_story.get_element_by_id("di2i3i1i2").set("Self", "di2i3i1i3")
+            other_story.synchronize()
+            self.assertEqual(story.get_element_by_id("di2i3i1i3").get("MarkupTag"), "XMLTag/subtitle")
+        finally:
+            idml_file.discard_working_copy()
+
     def test_create(self):
         from tempfile import mkdtemp
         idml_working_copy = mkdtemp()
@@ -411,6 +463,11 @@ class StyleTestCase(unittest.TestCase):
             'text': ''
         })
 
+        # Looked up in the index of Styles.xml.
+        self.assertTrue(style.get_style_node_by_name("CharacterStyle/bold") is style_node)
+        self.assertTrue(style.element_index[("Self", "CharacterStyle/bold")][0] is style_node)
+        self.assertRaises(IndexError, style.get_style_node_by_name, "CharacterStyle/foo")
+
 
 class StyleMappingTestCase(unittest.TestCase):
     def test_styles(self):
@@ -438,6 +495,42 @@ class StyleMappingTestCase(unittest.TestCase):
                           'bold': 'CharacterStyle/bold',
                           'sup': 'CharacterStyle/sup'})
 
+    def test_add_stylenodes(self):
+        idml_file = IDMLPackage(os.path.join(IDMLFILES_DIR, "article-1photo_import-xml.idml"), mode="r")
+        style_mapping = StyleMapping(idml_file)
+        character_style_mapping = style_mapping.character_style_mapping
+        style_mapping.add_stylenodes([
+            etree.Element("XMLImportMap", Self="foo1", MarkupTag="XMLTag/bold", MappedStyle="CharacterStyle/bold"),
+            etree.Element("XMLImportMap", Self="foo2", MarkupTag="XMLTag/em", MappedStyle="CharacterStyle/italique"),
+        ])
+        # The mapping of bold is already there.
+        self.assertEqual([n.get("Self") for n in style_mapping.iter_stylenode()],
+                         ["did2", "di13f", "di141", "foo2"])
+        # The character style mapping is updated, not computed again.
+        self.assertTrue(style_mapping.character_style_mapping is character_style_mapping)
+        self.assertEqual(style_mapping.character_style_mapping["em"], "CharacterStyle/italique")
+
+
+class TagsTestCase(unittest.TestCase):
+    def test_add_tags(self):
+        idml_file = IDMLPackage(os.path.join(IDMLFILES_DIR, "4-pages.idml"), mode="r")
+        other_idml_file = IDMLPackage(os.path.join(IDMLFILES_DIR, "article-1photo_import-xml.idml"), mode="r")
+        tags = Tags(idml_file)
+        self.assertEqual(tags.tag_ids, set([
+            'XMLTag/Root', 'XMLTag/Story', 'XMLTag/advertise', 'XMLTag/article', 'XMLTag/content',
+            'XMLTag/description', 'XMLTag/illustration', 'XMLTag/subtitle', 'XMLTag/title'
+        ]))
+
+        # Only the missing tags are appended.
+        tags.add_tags(Tags(other_idml_file).tags())
+        self.assertEqual([tag.get("Self") for tag in tags.tags()], [
+            'XMLTag/advertise', 'XMLTag/article', 'XMLTag/content', 'XMLTag/description',
+            'XMLTag/illustration', 'XMLTag/Root', 'XMLTag/Story', 'XMLTag/subtitle', 'XMLTag/title',
+            'XMLTag/bold', 'XMLTag/headline', 'XMLTag/informations', 'XMLTag/italique',
+            'XMLTag/main_picture', 'XMLTag/module', 'XMLTag/sup'
+        ])
+        self.assertEqual(len(tags.tag_ids), 16)
+
 
 class XMLElementTestCase(unittest.TestCase):
     def test_repr(self):
@@ -538,6 +631,39 @@ class XMLElementTestCase(unittest.TestCase):
         self.assertEqual(elt.get_character_style_range().get("AppliedCharacterStyle"), "CharacterStyle/$ID/MyOtherStyle")
 
 
+class XMLStructureIndexTestCase(unittest.TestCase):
+    def test_find(self):
+        root = etree.fromstring('<Root><article/><article><bold Self="b2"/></article></Root>')
+        index = XMLStructureIndex(root.getroottree())
+        self.assertEqual(index.find("/Root/article/bold").get("Self"), "b2")
+        self.assertEqual(index.find("/Root/article[2]/bold").get("Self"), "b2")
+
+        # A path without position may match another node once the structure has grown.
+        index.append(root[0], etree.Element("bold", Self="b1"))
+        self.assertEqual(index.find("/Root/article/bold").get("Self"), "b1")
+        self.assertEqual(index.find_by_id("b1"), root[0][0])
+
+    def test_append(self):
+        root = etree.fromstring('<Root><article><bold/></article><module/></Root>')
+        index = XMLStructureIndex(root.getroottree())
+        index.append(root, etree.fromstring('<article><bold/><bold/></article>'))
+        index.append(root[-1], etree.Element("italic"))
+        tree = root.getroottree()
+        self.assertEqual([index.getpath(node) for node in root.iter()],
+                         [tree.getpath(node) for node in root.iter()])
+        self.assertEqual(index.getpath(root[0][0]), "/Root/article[1]/bold")
+
+    def test_set_id(self):
+        root = etree.fromstring('<Root><article Self="a1"/></Root>')
+        index = XMLStructureIndex(root.getroottree())
+        node = etree.Element("bold")
+        index.append(root[0], node)
+        index.set_id(node, "b1")
+        self.assertEqual(node.get("Self"), "b1")
+        self.assertTrue(index.ids["b1"] is node)
+        self.assertTrue(index.find_by_id("b1") is node)
+
+
 def suite():
     suite = unittest.TestLoader().loadTestsFromTestCase(SpreadTestCase)
     suite.addTests(unittest.TestLoader().loadTestsFromTestCase(DesignmapTestCase))
@@ -545,5 +671,7 @@ def suite():
     suite.addTests(unittest.TestLoader().loadTestsFromTestCase(PageTestCase))
     suite.addTests(unittest.TestLoader().loadTestsFromTestCase(StyleTestCase))
     suite.addTests(unittest.TestLoader().loadTestsFromTestCase(StyleMappingTestCase))
+    suite.addTests(unittest.TestLoader().loadTestsFromTestCase(TagsTestCase))
     suite.addTests(unittest.TestLoader().loadTestsFromTestCase(XMLElementTestCase))
+    suite.addTests(unittest.TestLoader().loadTestsFromTestCase(XMLStructureIndexTestCase))
     return suite
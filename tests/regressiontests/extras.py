@@ -5,10 +5,17 @@ import shutil
 import glob
 import unittest
 import zipfile
-from simple_idml.extras import create_idml_package_from_dir
+import mock
+from lxml import etree
+from simple_idml.components import XMLStructureBuilder
+from simple_idml.extras import (create_idml_package_from_dir, export_xml_from_idml_packages,
+                                add_pages_from_idml_files, insert_idml_files, open_prepared_idml_package,
+                                prepare_idml_packages, remove_prepared_idml_package)
+from simple_idml.idml import IDMLPackage
 
 CURRENT_DIR = os.path.dirname(__file__)
 IDMLFILES_DIR = os.path.join(CURRENT_DIR, "IDML")
+XML_DIR = os.path.join(CURRENT_DIR, "XML")
 OUTPUT_DIR = os.path.join(CURRENT_DIR, "outputs")
 
 class ExtrasTestCase(unittest.TestCase):
@@ -42,6 +49,133 @@ class ExtrasTestCase(unittest.TestCase):
         self.assertRaises(IOError, create_idml_package_from_dir, src_dir + "-foo", destination.replace(".idml",
                                                                                                        "-2.idml"))
 
+    def test_export_xml_from_idml_packages(self):
+        sources = [
+            os.path.join(IDMLFILES_DIR, "4-pages.idml"),
+            os.path.join(XML_DIR, "article-1photo_import-xml.xml"),
+            os.path.join(IDMLFILES_DIR, "expected"),
+        ]
+        results = list(export_xml_from_idml_packages(sources, workers=2))
+        self.assertEqual([os.path.basename(r[0]) for r in results[:4]],
+                         ['4-pages.idml', 'article-1photo_import-xml.xml',
+                          '4-pages-insert-article-0-photo-complex.idml',
+                          '4-pages-insert-article-1-photo-complex.idml'])
+        self.assertEqual(len(results), 2 + len(glob.glob(os.path.join(IDMLFILES_DIR, "expected", "*.idml"))))
+
+        filename, xml, error = results[0]
+        with IDMLPackage(filename) as idml_file:
+            self.assertEqual(xml, idml_file.export_xml())
+        self.assertEqual(error, None)
+        # A failure does not stop the batch.
+        self.assertEqual(results[1][1:], (None, "BadZipFile: File is not a zip file"))
+        self.assertTrue(all(error is None for filename, xml, error in results[2:]))
+
+        filename, tree, error = next(export_xml_from_idml_packages(sources[:1], workers=1, as_tree=True))
+        self.assertEqual(tree["tag"], "Root")
+
+    def test_prepare_idml_packages(self):
+        for basename in ["article-1photo.idml", "magazineA-bloc-notes.idml"]:
+            shutil.copy2(os.path.join(IDMLFILES_DIR, basename), os.path.join(OUTPUT_DIR, basename))
+        article_filename = os.path.join(OUTPUT_DIR, "article-1photo.idml")
+        bloc_notes_filename = os.path.join(OUTPUT_DIR, "magazineA-bloc-notes.idml")
+
+        results = list(prepare_idml_packages([
+            (bloc_notes_filename, "blocnotes", [(1, "/Root/page[1]"), (2, "/Root/page[2]")]),
+            (os.path.join(XML_DIR, "article-1photo_import-xml.xml"), "foo", ["/Root"]),
+            (article_filename, "article1", ["/Root/module[1]"]),
+        ], workers=2))
+        self.assertEqual([r[0] for r in results], [bloc_notes_filename,
+                                                   os.path.join(XML_DIR, "article-1photo_import-xml.xml"),
+                                                   article_filename])
+        self.assertEqual(results[1][1:], (None, None, None, "BadZipFile: File is not a zip file"))
+        try:
+            # The source packages are left untouched, their copies are prefixed.
+            with IDMLPackage(article_filename) as article_idml_file:
+                self.assertEqual(article_idml_file.xml_structure.get("Self"), "di3")
+            prefixed_article_filename = results[2][1]
+            self.assertNotEqual(prefixed_article_filename, article_filename)
+            with IDMLPackage(prefixed_article_filename) as article_idml_file:
+                self.assertEqual(article_idml_file.xml_structure.get("Self"), "article1di3")
+                self.assertEqual(results[2][2], [article_idml_file.get_insert_referenced_resources("/Root/module[1]")])
+                self.assertEqual(results[2][3][1], etree.tostring(article_idml_file.xml_structure))
+
+            # The xml_structure computed is not built again.
+            with mock.patch.object(XMLStructureBuilder, "build") as build:
+                with open_prepared_idml_package(prefixed_article_filename, results[2][3]) as article_idml_file:
+                    self.assertEqual(article_idml_file.xml_structure.get("Self"), "article1di3")
+            self.assertFalse(build.called)
+            with IDMLPackage(results[0][1]) as bloc_notes_idml_file:
+                self.assertEqual(results[0][2], [bloc_notes_idml_file.get_page_referenced_resources(1, "/Root/page[1]"),
+                                                 bloc_notes_idml_file.get_page_referenced_resources(2, "/Root/page[2]")])
+        finally:
+            for result in [results[0], results[2]]:
+                remove_prepared_idml_package(result[1])
+        self.assertFalse(os.path.exists(os.path.dirname(prefixed_article_filename)))
+
+    def test_insert_idml_files(self):
+        for basename in ["4-pages.idml", "article-1photo.idml"]:
+            for dirname in [OUTPUT_DIR, os.path.join(OUTPUT_DIR, "sequential")]:
+                if not os.path.exists(dirname):
+                    os.makedirs(dirname)
+                shutil.copy2(os.path.join(IDMLFILES_DIR, basename), os.path.join(dirname, basename))
+
+        # The same insertion done sequentially.
+        with IDMLPackage(os.path.join(OUTPUT_DIR, "sequential", "4-pages.idml")) as main_idml_file,\
+             IDMLPackage(os.path.join(OUTPUT_DIR, "sequential", "article-1photo.idml")) as article_idml_file:
+            with main_idml_file.prefix("main") as prefixed_main,\
+                 article_idml_file.prefix("article1") as prefixed_article:
+                with prefixed_main.insert_idml(prefixed_article, at="/Root/article[3]", only="/Root/module[1]") as f:
+                    expected_xml = f.export_xml()
+                    expected_styles = f.style.tostring()
+
+        with IDMLPackage(os.path.join(OUTPUT_DIR, "4-pages.idml")) as main_idml_file:
+            with main_idml_file.prefix("main") as prefixed_main:
+                insert_idml_files(prefixed_main, [
+                    (os.path.join(OUTPUT_DIR, "article-1photo.idml"), "article1", "/Root/article[3]", "/Root/module[1]"),
+                ], workers=1)
+                self.assertEqual(prefixed_main.export_xml(), expected_xml)
+                self.assertEqual(prefixed_main.style.tostring(), expected_styles)
+
+    def test_add_pages_from_idml_files(self):
+        edito_idml_filename = os.path.join(OUTPUT_DIR, "magazineA-edito.idml")
+        courrier_idml_filename = os.path.join(OUTPUT_DIR, "magazineA-courrier-des-lecteurs.idml")
+        bloc_notes_idml_filename = os.path.join(OUTPUT_DIR, "magazineA-bloc-notes.idml")
+        for filename in [edito_idml_filename, courrier_idml_filename, bloc_notes_idml_filename]:
+            shutil.copy2(os.path.join(IDMLFILES_DIR, os.path.basename(filename)), filename)
+
+        pages = [
+            (courrier_idml_filename, "courrier", 1, "/Root", "/Root/page[1]"),
+            (bloc_notes_idml_filename, "blocnotes", 1, "/Root", "/Root/page[1]"),
+            (bloc_notes_idml_filename, "blocnotes", 2, "/Root", "/Root/page[2]"),
+        ]
+        with IDMLPackage(edito_idml_filename) as edito_idml_file:
+            with edito_idml_file.prefix("edito") as prefixed_edito:
+                add_pages_from_idml_files(prefixed_edito, pages, workers=2)
+                self.assertEqual(len(prefixed_edito.pages), 5)
+                self.assertEqual([n.get("src") for n in prefixed_edito.designmap.spread_nodes],
+                                 ['Spreads/Spread_editoub6.xml',
+                                  'Spreads/Spread_editoubc.xml',
+                                  'Spreads/Spread_editoubd.xml'])
+                self.assertEqual([e.get("Self") for e in prefixed_edito.xml_structure.iterchildren()],
+                                 ["editodi2ib", "editodi2i10", "courrierdi2ib", "blocnotesdi2ib", "blocnotesdi2i10"])
+
+        # The source files are not prefixed, so they can be added again.
+        with IDMLPackage(courrier_idml_filename) as courrier_idml_file:
+            self.assertEqual(courrier_idml_file.xml_structure.get("Self"), "di2")
+        with mock.patch("simple_idml.extras.remove_prepared_idml_package") as remove:
+            with IDMLPackage(edito_idml_filename) as edito_idml_file:
+                add_pages_from_idml_files(edito_idml_file, pages[:1], workers=1)
+        self.assertEqual(remove.call_count, 1)
+        prefixed_filename = remove.call_args[0][0]
+        with IDMLPackage(prefixed_filename) as courrier_idml_file:
+            self.assertEqual(courrier_idml_file.xml_structure.get("Self"), "courrierdi2")
+        remove_prepared_idml_package(prefixed_filename)
+
+        # A file cannot be prefixed twice.
+        self.assertRaises(ValueError, add_pages_from_idml_files, edito_idml_file,
+                          [(courrier_idml_filename, "courrier", 1, "/Root", "/Root/page[1]"),
+                           (courrier_idml_filename, "other", 1, "/Root", "/Root/page[1]")])
+
 
 def suite():
     suite = unittest.TestLoader().loadTestsFromTestCase(ExtrasTestCase)
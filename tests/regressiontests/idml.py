@@ -2,14 +2,20 @@
 
 import datetime
 import glob
+import io
 import os
 import shutil
 import unittest
+import warnings
+import zipfile
+import mock
 from tempfile import gettempdir, mkdtemp
 from lxml import etree
+from simple_idml.components import Spread
+from simple_idml.exceptions import MergeConflictWarning
 from simple_idml.idml import IDMLPackage
 from simple_idml.test import SimpleTestCase
-from simple_idml.utils import etree_dom_to_tree
+from simple_idml.utils import etree_dom_to_tree, tree_to_etree_dom
 
 CURRENT_DIR = os.path.dirname(__file__)
 IDMLFILES_DIR = os.path.join(CURRENT_DIR, "IDML")
@@ -246,6 +252,56 @@ class IdmlTestCase(SimpleTestCase):
 </Root>
 """)
 
+    def test_get_xml_structure(self):
+        idml_filename = os.path.join(IDMLFILES_DIR, "4-pages.idml")
+        with IDMLPackage(idml_filename) as idml_file:
+            # Streamed: the DOM of the stories are not loaded.
+            structure = idml_file.get_xml_structure()
+            self.assertEqual(idml_file.get_story_object("Stories/Story_u102.xml")._dom, None)
+            self.assertXMLEqual(etree.tostring(structure).decode("utf-8"),
+                                etree.tostring(idml_file.xml_structure).decode("utf-8"))
+
+            self.assertXMLEqual(etree.tostring(idml_file.get_xml_structure("/Root/article[1]/Story"),
+                                               pretty_print=True).decode("utf-8"),
+"""<Story XMLContent="ue4" Self="di2i3i1">
+  <title Self="di2i3i1i1"/>
+  <subtitle Self="di2i3i1i2"/>
+</Story>
+""")
+            self.assertEqual(idml_file.get_xml_structure("/Root/article[3]").get("Self"), "di2i5")
+            self.assertEqual(idml_file.get_xml_structure("/Root/article[4]"), None)
+            self.assertEqual(idml_file.get_xml_structure("/Root/foo/Story"), None)
+            # Any other XPath is evaluated on the whole structure.
+            self.assertEqual(idml_file.get_xml_structure("//*[@XMLContent='udf']").tag, "advertise")
+            self.assertEqual(idml_file.get_xml_structure("/Root/article[1]/Story/title",
+                                                         streaming=False).get("Self"), "di2i3i1i1")
+
+    def test_xml_structure_index(self):
+        idml_filename = os.path.join(IDMLFILES_DIR, "4-pages.idml")
+        with IDMLPackage(idml_filename) as idml_file:
+            index = idml_file.xml_structure_index
+            story_node = idml_file.get_xml_structure_node_by_xpath("/Root/article[1]/Story")
+            self.assertEqual(index.nodes["/Root/article[1]/Story"], story_node)
+            self.assertEqual(index.getpath(story_node), "/Root/article[1]/Story")
+            self.assertEqual(index.find_by_id("di2i3i1"), story_node)
+            self.assertEqual(index.find("/Root/advertise").get("XMLContent"), "udf")
+            self.assertRaises(IndexError, idml_file.get_xml_structure_node_by_xpath, "/Root/foo")
+
+            # Other paths are evaluated: they may match another node once the structure has grown.
+            self.assertEqual(index.find("/Root/article/Story"), story_node)
+            self.assertFalse("/Root/article/Story" in index.nodes)
+            self.assertEqual(index.find("//title").get("Self"), "di2i3i1i1")
+            self.assertFalse("//title" in index.nodes)
+
+            # An appended node is indexed and the path of its sibling gets a position.
+            advertise_node = index.find("/Root/advertise")
+            new_node = etree.Element("advertise", Self="foo")
+            index.append(idml_file.xml_structure, new_node)
+            self.assertEqual(index.getpath(advertise_node), "/Root/advertise[1]")
+            self.assertEqual(index.find("/Root/advertise[2]"), new_node)
+            self.assertEqual(index.find("/Root/advertise"), advertise_node)
+            self.assertEqual(index.find_by_id("foo"), new_node)
+
     def test_get_story_by_xpath(self):
         idml_filename = os.path.join(IDMLFILES_DIR, "4-pages.idml")
         with IDMLPackage(idml_filename) as idml_file:
@@ -302,6 +358,104 @@ class IdmlTestCase(SimpleTestCase):
             spread = idml_file.get_spread_object_by_xpath("/Root/module/main_picture")
             self.assertEqual(spread.name, "Spreads/Spread_ud8.xml")
 
+    def test_spread_index(self):
+        with IDMLPackage(os.path.join(IDMLFILES_DIR, "4-pages.idml")) as idml_file:
+            spread, elt = idml_file.spread_index["udf"]
+            self.assertEqual((spread.name, elt.tag), ("Spreads/Spread_ub6.xml", "Rectangle"))
+            # Pointing the story.
+            spread, elt = idml_file.spread_index["u102"]
+            self.assertEqual((spread.name, elt.tag, elt.get("Self")),
+                             ("Spreads/Spread_ub6.xml", "TextFrame", "ud8"))
+            self.assertEqual(idml_file.get_spread_object_by_id("u102"), spread)
+            self.assertEqual(idml_file.get_spread_object_by_id(None), None)
+
+            # A miss in the index is authoritative.
+            with mock.patch.object(Spread, "get_element_by_id") as get_element_by_id:
+                self.assertEqual(idml_file.get_spread_object_by_id("u9c"), None)
+            self.assertFalse(get_element_by_id.called)
+
+        idml_filename = os.path.join(OUTPUT_DIR, "4-pages-spread-index.idml")
+        shutil.copy2(os.path.join(IDMLFILES_DIR, "4-pages.idml"), idml_filename)
+        with IDMLPackage(idml_filename) as idml_file:
+            with idml_file.edit() as doc:
+                spread, elt = doc.spread_index["u102"]
+                # The page item is moved onto another spread.
+                other_spread = doc.get_spread_object_by_name("Spreads/Spread_uc3.xml")
+                other_spread.node.append(elt)
+                other_spread.synchronize()
+                self.assertEqual(doc.get_spread_object_by_id("u102").name, "Spreads/Spread_uc3.xml")
+                self.assertEqual(doc.spread_index["u102"][0].name, "Spreads/Spread_uc3.xml")
+
+                # Or removed.
+                doc.get_spread_object_by_name("Spreads/Spread_uc3.xml").remove_page_item("u102", synchronize=True)
+                self.assertEqual(doc.get_spread_object_by_id("u102"), None)
+
+    def test_get_story_object(self):
+        idml_filename = os.path.join(OUTPUT_DIR, "article-1photo_import-xml-story-objects.idml")
+        shutil.copy2(os.path.join(IDMLFILES_DIR, "article-1photo_import-xml.idml"), idml_filename)
+        with IDMLPackage(idml_filename) as idml_file:
+            story = idml_file.get_story_object_by_xpath("/Root/module[1]/Story")
+            self.assertEqual(story.name, "Stories/Story_uf7.xml")
+            self.assertTrue(idml_file.get_story_object("Stories/Story_uf7.xml") is story)
+            self.assertTrue(idml_file.get_story_object_by_xpath("/Root") is idml_file.backing_story)
+
+            with idml_file.edit() as doc:
+                # The working copy has its own objects, shared for the whole session.
+                story = doc.get_story_object_by_xpath("/Root/module[1]/Story")
+                self.assertEqual(story.working_copy_path, doc.working_copy_path)
+                doc.prefix("myprefix")
+                self.assertEqual(story.name, "Stories/Story_myprefixuf7.xml")
+                self.assertTrue(doc.get_story_object_by_xpath("/Root/module[1]/Story") is story)
+                # Flushing releases them.
+                doc.flush()
+                self.assertFalse(doc.get_story_object_by_xpath("/Root/module[1]/Story") is story)
+
+    def test_read_only(self):
+        idml_filename = os.path.join(IDMLFILES_DIR, "article-1photo_import-xml.idml")
+        with IDMLPackage(idml_filename, read_only=True) as idml_file:
+            # The elements are those of the DOM shared by the components.
+            from simple_idml.components import Tags
+            tags = idml_file.tags
+            self.assertEqual([t.get("Self") for t in tags],
+                             [t.get("Self") for t in IDMLPackage(idml_filename).tags])
+            self.assertTrue(tags[0].getroottree().getroot() is Tags(idml_file).dom)
+            self.assertTrue(idml_file.font_families[0].getparent() is not None)
+            self.assertTrue(idml_file.style_groups[0].getparent() is not None)
+
+            # Same result than a package opened the default way.
+            self.assertEqual(idml_file.export_xml(), IDMLPackage(idml_filename).export_xml())
+
+            # No working copy.
+            self.assertRaises(ValueError, idml_file.prefix, "FOO")
+            self.assertRaises(ValueError, idml_file.edit().__enter__)
+            self.assertEqual(idml_file.working_copy_path, None)
+
+        self.assertRaises(ValueError, IDMLPackage, os.path.join(OUTPUT_DIR, "read-only.idml"),
+                          mode="w", read_only=True)
+
+    def test_get_member_buffer(self):
+        idml_filename = os.path.join(OUTPUT_DIR, "article-1photo_import-xml-mmap.idml")
+        shutil.copy2(os.path.join(IDMLFILES_DIR, "article-1photo_import-xml.idml"), idml_filename)
+        with IDMLPackage(idml_filename) as idml_file:
+            # Members written by InDesign are compressed.
+            self.assertEqual(idml_file.getinfo("XML/Tags.xml").compress_type, zipfile.ZIP_DEFLATED)
+            self.assertEqual(idml_file.get_member_buffer("XML/Tags.xml"), None)
+            self.assertEqual(idml_file.get_member_buffer("XML/Unknown.xml"), None)
+            tags = [t.get("Self") for t in idml_file.tags]
+
+            with idml_file.prefix("FOO") as prefixed_file:
+                # Serialized members are stored.
+                self.assertEqual(prefixed_file.getinfo("XML/Tags.xml").compress_type, zipfile.ZIP_STORED)
+                with prefixed_file.get_member_buffer("XML/Tags.xml") as buf:
+                    self.assertEqual(buf.tobytes(), prefixed_file.read("XML/Tags.xml"))
+                self.assertEqual([t.get("Self") for t in prefixed_file.tags], tags)
+                self.assertEqual(prefixed_file.get_xml_structure("/Root/module[1]/Story", streaming=True).get("Self"),
+                                 "FOOdi3i4i3")
+
+                with prefixed_file.edit() as doc:
+                    self.assertEqual(doc.get_member_buffer("XML/Tags.xml"), None)
+            self.assertEqual(prefixed_file.mmap, None)
+
     def test_get_element_content_id_by_xpath(self):
         with IDMLPackage(os.path.join(IDMLFILES_DIR, "article-1photo_import-xml.idml")) as idml_file:
             element_id = idml_file.get_element_content_id_by_xpath("/Root/module/main_picture")
@@ -340,6 +494,88 @@ class IdmlTestCase(SimpleTestCase):
 </Root>
 """)
 
+    def test_import_xml_many(self):
+        shutil.copy2(os.path.join(IDMLFILES_DIR, "article-1photo_import-xml.idml"),
+                     os.path.join(OUTPUT_DIR, "article-1photo_import-xml-many.idml"))
+        with IDMLPackage(os.path.join(OUTPUT_DIR, "article-1photo_import-xml-many.idml")) as idml_file:
+            imports = [
+                ("<headline>The Life Aquatic with Steve Zissou</headline>", "/Root/module[1]/headline"),
+                ("<Story><article>An American comedy-drama film.</article></Story>", "/Root/module[1]/Story"),
+                ("<informations>Directed by Wes Anderson.</informations>", "/Root/module[1]/Story/informations"),
+            ]
+            with idml_file.import_xml_many(imports) as f:
+                self.assertXMLEqual(f.export_xml(),
+"""<Root>
+  <module>
+    <main_picture href="file:///Users/stan/Dropbox/Projets/Slashdev/SimpleIDML/repos/git/simpleidml/tests/regressiontests/IDML/media/default.jpg"/>
+    <headline>The Life Aquatic with Steve Zissou</headline>
+    <Story>
+      <article>An American comedy-drama film.</article>
+      <informations>Directed by Wes Anderson.</informations>
+    </Story>
+  </module>
+</Root>
+""")
+
+    def test_import_xml_streaming(self):
+        xml_filename = os.path.join(XML_DIR, "article-1photo_import-xml-with-extra-nodes2.xml")
+        exports = []
+        for streaming in (False, True):
+            idml_filename = os.path.join(OUTPUT_DIR, "article-1photo_import-xml-streaming.idml")
+            shutil.copy2(os.path.join(IDMLFILES_DIR, "article-1photo_import-xml.idml"), idml_filename)
+            with IDMLPackage(idml_filename) as idml_file, open(xml_filename, "r") as xml_file:
+                xml = xml_filename if streaming else xml_file.read()
+                with idml_file.import_xml(xml, at="/Root/module[1]", streaming=streaming) as f:
+                    exports.append(f.export_xml())
+        self.assertMultiLineEqual(exports[0], exports[1])
+
+        # A file-like object with new nodes and some text around.
+        shutil.copy2(os.path.join(IDMLFILES_DIR, "article-1photo_import-xml.idml"), idml_filename)
+        with IDMLPackage(idml_filename) as idml_file:
+            xml = io.BytesIO(b"<article>While <bold>Steve Zissou</bold> is at sea, "
+                             b"his <italique>friend</italique> is eaten.</article>")
+            with idml_file.import_xml(xml, at="/Root/module[1]/Story/article", streaming=True) as f:
+                self.assertEqual(etree.fromstring(f.export_xml()).find("module/Story/article").xpath("string()"),
+                                 "While Steve Zissou is at sea, his friend is eaten.")
+
+    def test_import_xml_plan(self):
+        template_filename = os.path.join(IDMLFILES_DIR, "article-1photo_import-xml.idml")
+        with IDMLPackage(template_filename) as template, \
+             open(os.path.join(XML_DIR, "article-1photo_import-xml.xml"), "r") as xml_file:
+            plan = template.compile_import_xml(xml_file.read(), at="/Root/module[1]")
+        # <article> has new elements (<bold>...) and is imported with import_xml().
+        self.assertEqual([(step[0], step[2]) for step in plan.steps], [
+            ("import", "/Root/module[1]"),
+            ("import", "/Root/module/main_picture"),
+            ("import", "/Root/module/headline"),
+            ("import", "/Root/module/Story"),
+            ("import_xml", "/Root/module/Story/article"),
+            ("import", "/Root/module/Story/informations"),
+        ])
+
+        xmls = [
+            """<module><main_picture href="file:///foo.jpg"/><headline>Foo</headline><Story>
+                 <article>Foo <bold>bar</bold>.</article><informations>Foo bar</informations></Story></module>""",
+            """<module><main_picture href="file:///bar.jpg"/><headline>Bar</headline><Story>
+                 <article>Bar <italique>foo</italique>.</article><informations>Bar foo</informations></Story></module>""",
+            # Not the same shape.
+            """<module><main_picture href="file:///baz.jpg"/><headline>Baz</headline></module>""",
+        ]
+        idml_filename = os.path.join(OUTPUT_DIR, "article-1photo_import-xml-plan.idml")
+        for xml in xmls:
+            exports = []
+            for use_plan in (False, True):
+                shutil.copy2(template_filename, idml_filename)
+                with IDMLPackage(idml_filename) as idml_file:
+                    if use_plan:
+                        new_idml_file = idml_file.import_xml_plan(plan, xml)
+                    else:
+                        new_idml_file = idml_file.import_xml(xml, at="/Root/module[1]")
+                    with new_idml_file as f:
+                        exports.append(f.export_xml())
+            self.assertMultiLineEqual(exports[0], exports[1])
+        self.assertTrue("<headline>Baz</headline>" in exports[1])
+
     def test_import_xml_nested_tags(self):
         shutil.copy2(os.path.join(IDMLFILES_DIR, "article-1photo_import-xml.idml"),
                      os.path.join(OUTPUT_DIR, "article-1photo_import-xml-nested-tags.idml"))
@@ -361,6 +597,22 @@ class IdmlTestCase(SimpleTestCase):
 </Root>
 """)
 
+    def test_import_xml_character_style_ranges(self):
+        shutil.copy2(os.path.join(IDMLFILES_DIR, "article-1photo_import-xml.idml"),
+                     os.path.join(OUTPUT_DIR, "article-1photo_import-xml-character-style-ranges.idml"))
+        with IDMLPackage(os.path.join(OUTPUT_DIR, "article-1photo_import-xml-character-style-ranges.idml")) as idml_file,\
+             open(os.path.join(XML_DIR, "article-1photo_import-xml-nested-tags.xml"), "r") as xml_file:
+            with idml_file.edit() as doc:
+                doc.import_xml(xml_file.read(), at="/Root/module[1]")
+                # The merged styles are kept by tags chain.
+                style_range_node, root_style_node = doc.character_style_ranges[
+                    ("italique", "bold", "article", "Story", "module", "Root")]
+                self.assertEqual(root_style_node.get("Self"), "CharacterStyle/bold")
+                self.assertEqual(style_range_node.get("FontStyle"), "Bold Italic")
+                self.assertEqual(style_range_node.getparent(), None)
+            # The cache is reset with the lazy references.
+            self.assertEqual(idml_file.character_style_ranges, {})
+
     def test_import_xml_with_ignored_tags(self):
         shutil.copy2(os.path.join(IDMLFILES_DIR, "article-1photo_import-xml.idml"),
                      os.path.join(OUTPUT_DIR, "article-1photo_import-xml-with-extra-nodes.idml"))
@@ -425,6 +677,100 @@ class IdmlTestCase(SimpleTestCase):
 </Root>
 """)
 
+    def test_edit(self):
+        idml_filename = os.path.join(OUTPUT_DIR, "article-1photo_import-xml-edit.idml")
+        shutil.copy2(os.path.join(IDMLFILES_DIR, "article-1photo_import-xml.idml"), idml_filename)
+        with IDMLPackage(idml_filename) as idml_file,\
+             open(os.path.join(XML_DIR, "article-1photo_import-xml-with-extra-nodes2.xml"), "r") as xml_file:
+            with idml_file.edit() as doc:
+                self.assertTrue(doc is idml_file)
+                working_copy_path = doc.working_copy_path
+                self.assertEqual(doc.prefix("myprefix"), doc)
+                self.assertEqual(set(doc.stories), set(['Stories/Story_myprefixu10d.xml',
+                                                        'Stories/Story_myprefixuf7.xml',
+                                                        'Stories/Story_myprefixue1.xml']))
+                doc.import_xml(xml_file.read(), at="/Root/module[1]")
+                doc.add_note("This is an important message", "Stanislas Guerra", at="/Root/module[1]")
+                # Nothing is written in the archive until the end of the session.
+                self.assertEqual(zipfile.ZipFile(idml_filename).namelist()[-4:],
+                                 ['Stories/Story_u10d.xml', 'Stories/Story_uf7.xml',
+                                  'Stories/Story_ue1.xml', 'XML/Mapping.xml'])
+
+            self.assertFalse(os.path.exists(working_copy_path))
+            self.assertEqual(idml_file.working_copy_path, None)
+            self.assertTrue(idml_file.is_prefixed("myprefix"))
+            self.assertMultiLineEqual(idml_file.export_xml(),
+"""<Root>
+  <module>
+    <main_picture href="file:../../IDML/media/bouboune.jpg"/>
+    <headline>The Life Aquatic with Steve Zissou</headline>
+    <Story>
+      <article><italique>While oceanographer and documentarian</italique><bold>Steve Zissou (Bill Murray) is working on his latest documentary at sea, his best friend Esteban du Plantier (Seymour Cassel)</bold> is eaten by a creature Zissou describes as a "Jaguar shark." For his next project, Zissou is determined to document the shark's destruction.
+            The crew aboard Zissou's research vessel <italique>Belafonte</italique> includes <italique>Pel&#233; dos Santos (Seu Jorge)</italique>, a safety expert and Brazilian musician who sings David Bowie songs in Portuguese, and Klaus Daimler (Willem Dafoe), the German second-in-command who viewed Zissou and Esteban as father figures</article>
+      <informations>The Life Aquatic with Steve Zissou is an American comedy-drama film directed, written, and co-produced by Wes Anderson.</informations>
+    </Story>
+  </module>
+</Root>
+""")
+            story = idml_file.get_story_object_by_xpath("/Root/module[1]")
+            self.assertEqual(story.name, "Stories/Story_myprefixu10d.xml")
+            self.assertEqual(story.get_element_by_id("myprefixdi3i4").find("Note").get("UserName"),
+                             "Stanislas Guerra")
+
+    def test_edit_exception(self):
+        idml_filename = os.path.join(OUTPUT_DIR, "article-1photo_import-xml-edit-exception.idml")
+        shutil.copy2(os.path.join(IDMLFILES_DIR, "article-1photo_import-xml.idml"), idml_filename)
+        with IDMLPackage(idml_filename) as idml_file:
+            with self.assertRaises(ValueError):
+                with idml_file.edit() as doc:
+                    working_copy_path = doc.working_copy_path
+                    doc.prefix("myprefix")
+                    self.assertEqual(doc.designmap.active_layer, "myprefixua4")
+                    self.assertEqual(doc.xml_structure.get("Self"), "myprefixdi3")
+                    raise ValueError
+            # The package is left untouched.
+            self.assertFalse(os.path.exists(working_copy_path))
+            self.assertEqual(idml_file.working_copy_path, None)
+            self.assertFalse(idml_file.is_prefixed("myprefix"))
+            # In memory as well.
+            self.assertEqual(idml_file.designmap.active_layer, "ua4")
+            self.assertEqual(idml_file.xml_structure.get("Self"), "di3")
+
+    def test_commit_working_copy(self):
+        idml_filename = os.path.join(OUTPUT_DIR, "article-1photo_import-xml-commit.idml")
+        shutil.copy2(os.path.join(IDMLFILES_DIR, "article-1photo_import-xml.idml"), idml_filename)
+        with zipfile.ZipFile(idml_filename) as initial_archive:
+            initial_infos = dict((i.filename, i) for i in initial_archive.infolist())
+            initial_contents = dict((n, initial_archive.read(n)) for n in initial_archive.namelist())
+
+        with IDMLPackage(idml_filename) as idml_file:
+            with idml_file.edit() as doc:
+                doc.add_note("This is an important message", "Stanislas Guerra", at="/Root/module[1]")
+                # The modifications are kept in memory.
+                self.assertEqual(list(doc.working_copy_dirty_files.keys()), ["Stories/Story_u10d.xml"])
+                story = doc.working_copy_dirty_files["Stories/Story_u10d.xml"]
+                self.assertTrue(story.dirty)
+                with open(os.path.join(doc.working_copy_path, story.name), "rb") as story_file:
+                    self.assertEqual(story_file.read(), initial_contents[story.name])
+
+                doc.flush()
+                self.assertFalse(story.dirty)
+                self.assertEqual(doc.working_copy_dirty_files, {})
+                with open(os.path.join(doc.working_copy_path, story.name), "rb") as story_file:
+                    self.assertEqual(story_file.read(), story.tostring())
+
+        with zipfile.ZipFile(idml_filename) as archive:
+            self.assertEqual(archive.testzip(), None)
+            self.assertEqual(archive.namelist(), list(initial_infos.keys()))
+            for info in archive.infolist():
+                if info.filename == "Stories/Story_u10d.xml":
+                    self.assertNotEqual(archive.read(info), initial_contents[info.filename])
+                # Untouched files are copied as they are.
+                else:
+                    self.assertEqual(info.date_time, initial_infos[info.filename].date_time)
+                    self.assertEqual(info.CRC, initial_infos[info.filename].CRC)
+                    self.assertEqual(archive.read(info), initial_contents[info.filename])
+
     def test_import_xml_with_setcontent_false(self):
         shutil.copy2(os.path.join(IDMLFILES_DIR, "article-1photo_import-xml.idml"),
                      os.path.join(OUTPUT_DIR, "article-1photo_import-xml-with-setcontent-false.idml"))
@@ -792,6 +1138,43 @@ class IdmlTestCase(SimpleTestCase):
 </Root>
 """)
 
+    def test_export_xml_from_tag(self):
+        filename = os.path.join(IDMLFILES_DIR, "article-1photo_imported-nested-xml.idml")
+        with IDMLPackage(filename) as idml_file:
+            # Only the stories along the path and under the node are read.
+            xml = idml_file.export_xml(from_tag="/Root/module/Story")
+            self.assertTrue(xml.startswith("<Story>\n  <article>While oceanographer"))
+            self.assertNotIn("Stories/Story_ue5.xml", idml_file._story_objects)
+            self.assertIsNone(idml_file._xml_structure)
+
+            self.assertEqual(idml_file.export_xml(from_tag="/Root/module/headline"),
+                             "<headline>The Life Aquatic with Steve Zissou</headline>\n")
+            self.assertEqual(idml_file.export_as_tree(from_tag="/Root/module/Story")["content"][1],
+                             {"tag": "informations", "attrs": {},
+                              "content": ["The Life Aquatic with Steve Zissou is an American comedy-drama "
+                                          "film directed, written, and co-produced by Wes Anderson."]})
+
+            self.assertRaises(IndexError, idml_file.export_xml, from_tag="/Root/foo")
+
+        # Same result from the computed xml_structure.
+        with IDMLPackage(filename) as idml_file:
+            idml_file.xml_structure
+            self.assertEqual(idml_file.export_xml(from_tag="/Root/module/Story"), xml)
+
+    def test_export_xml_to_file(self):
+        with IDMLPackage(os.path.join(IDMLFILES_DIR, "article-1photo_imported-nested-xml.idml")) as idml_file:
+            xml_filename = os.path.join(OUTPUT_DIR, "article-1photo_imported-nested-xml.xml")
+            idml_file.export_xml_to_file(xml_filename)
+            with open(xml_filename, "r") as xml_file:
+                self.assertMultiLineEqual(xml_file.read(), idml_file.export_xml())
+
+            # Same result than serializing the tree.
+            output = io.BytesIO()
+            idml_file.export_xml_to_file(output, encoding="iso-8859-1")
+            self.assertEqual(output.getvalue(),
+                             etree.tostring(tree_to_etree_dom(idml_file.export_as_tree()),
+                                            encoding="iso-8859-1", pretty_print=True))
+
     def test_prefix(self):
         shutil.copy2(os.path.join(IDMLFILES_DIR, "4-pages.idml"),
                      os.path.join(OUTPUT_DIR, "4-pages.idml"))
@@ -885,6 +1268,91 @@ class IdmlTestCase(SimpleTestCase):
             with idml_file.suffix_layers(" - 23") as f:
                 self.assertEqual(f.designmap.layer_nodes[0].get("Name"), "Layer 1 - 23")
 
+    def test_add_styles_from_idml(self):
+        idml_filename = os.path.join(OUTPUT_DIR, "article-1photo_import-xml-styles.idml")
+        other_idml_filename = os.path.join(OUTPUT_DIR, "article-1photo_import-xml-other-styles.idml")
+        shutil.copy2(os.path.join(IDMLFILES_DIR, "article-1photo_import-xml.idml"), idml_filename)
+        shutil.copy2(os.path.join(IDMLFILES_DIR, "article-1photo_import-xml.idml"), other_idml_filename)
+
+        with IDMLPackage(other_idml_filename) as other_idml_file:
+            with other_idml_file.edit() as doc:
+                doc.style.get_style_node_by_name("CharacterStyle/bold").set("FontStyle", "Bold Italic")
+                doc.style.synchronize()
+
+        def _get_style_ids(idml_file):
+            return [elt.get("Self") for elt in idml_file.style.dom.iter(tag=etree.Element) if elt.get("Self")]
+
+        with IDMLPackage(idml_filename) as idml_file,\
+             IDMLPackage(other_idml_filename) as other_idml_file:
+            style_ids = _get_style_ids(idml_file)
+            with idml_file.edit() as doc:
+                with warnings.catch_warnings(record=True) as caught_warnings:
+                    warnings.simplefilter("always")
+                    doc._add_styles_from_idml(other_idml_file)
+            # The identical styles are not duplicated, the existing definition is kept.
+            self.assertEqual(_get_style_ids(idml_file), style_ids)
+            self.assertEqual(idml_file.style.get_style_node_by_name("CharacterStyle/bold").get("FontStyle"), "Bold")
+            self.assertEqual([w.category for w in caught_warnings], [MergeConflictWarning])
+            self.assertIn("CharacterStyle/bold", str(caught_warnings[0].message))
+
+    def test_add_graphics_from_idml(self):
+        idml_filename = os.path.join(OUTPUT_DIR, "article-1photo_import-xml-graphic.idml")
+        other_idml_filename = os.path.join(OUTPUT_DIR, "article-1photo_import-xml-other-graphic.idml")
+        shutil.copy2(os.path.join(IDMLFILES_DIR, "article-1photo_import-xml.idml"), idml_filename)
+        shutil.copy2(os.path.join(IDMLFILES_DIR, "article-1photo_import-xml.idml"), other_idml_filename)
+
+        with IDMLPackage(other_idml_filename) as other_idml_file:
+            with other_idml_file.edit() as doc:
+                doc.graphic.get_element_by_id("Color/u70", tag="Color").set("ColorValue", "0 0 0 50")
+                doc.graphic.dom.append(etree.Element("Color", Self="Color/foo", Model="Process",
+                                                     Space="CMYK", ColorValue="0 0 0 100"))
+                doc.graphic.synchronize()
+
+        with IDMLPackage(idml_filename) as idml_file,\
+             IDMLPackage(other_idml_filename) as other_idml_file:
+            graphic_ids = [elt.get("Self") for elt in idml_file.graphic.dom.iterchildren()]
+            with idml_file.edit() as doc:
+                with warnings.catch_warnings(record=True) as caught_warnings:
+                    warnings.simplefilter("always")
+                    doc._add_graphics_from_idml(other_idml_file)
+            # Only the new color is added, the existing definition is kept.
+            self.assertEqual([elt.get("Self") for elt in idml_file.graphic.dom.iterchildren()],
+                             graphic_ids + ["Color/foo"])
+            self.assertNotEqual(idml_file.graphic.get_element_by_id("Color/u70", tag="Color").get("ColorValue"),
+                                "0 0 0 50")
+            self.assertEqual([w.category for w in caught_warnings], [MergeConflictWarning])
+            self.assertIn("Color/u70", str(caught_warnings[0].message))
+
+    def test_add_referenced_graphics_from_idml(self):
+        idml_filename = os.path.join(OUTPUT_DIR, "article-1photo_import-xml-referenced-graphic.idml")
+        other_idml_filename = os.path.join(OUTPUT_DIR, "article-1photo_import-xml-other-referenced-graphic.idml")
+        shutil.copy2(os.path.join(IDMLFILES_DIR, "article-1photo_import-xml.idml"), idml_filename)
+        shutil.copy2(os.path.join(IDMLFILES_DIR, "article-1photo_import-xml.idml"), other_idml_filename)
+
+        with IDMLPackage(other_idml_filename) as other_idml_file:
+            with other_idml_file.edit() as doc:
+                doc.graphic.dom.append(etree.Element("Color", Self="Color/spot", Model="Spot",
+                                                     Space="CMYK", ColorValue="0 100 0 0", Name="PANTONE 123"))
+                doc.graphic.dom.append(etree.Element("Ink", Self="Ink/spot", Name="PANTONE 123"))
+                doc.graphic.dom.append(etree.Element("Color", Self="Color/other", Model="Process",
+                                                     Space="CMYK", ColorValue="0 0 0 100"))
+                doc.graphic.dom.append(etree.Element("Unidentified"))
+                doc.graphic.synchronize()
+
+        with IDMLPackage(idml_filename) as idml_file,\
+             IDMLPackage(other_idml_filename) as other_idml_file:
+            # The spot ink is referenced through the name of its color.
+            referenced = other_idml_file.get_referenced_resources([etree.Element("Rectangle", FillColor="Color/spot")])
+            self.assertIn("Ink/spot", referenced)
+            self.assertNotIn("Color/other", referenced)
+
+            graphic_ids = [elt.get("Self") for elt in idml_file.graphic.dom.iterchildren()]
+            with idml_file.edit() as doc:
+                doc._add_graphics_from_idml(other_idml_file, referenced=referenced)
+            # The nodes without id are kept.
+            self.assertEqual([elt.get("Self") for elt in idml_file.graphic.dom.iterchildren()],
+                             graphic_ids + ["Color/spot", "Ink/spot", None])
+
     def test_insert_idml(self):
         shutil.copy2(os.path.join(IDMLFILES_DIR, "4-pages.idml"),
                      os.path.join(OUTPUT_DIR, "4-pages-insert-article-1-photo.idml"))
@@ -2119,11 +2587,10 @@ class IdmlTestCase(SimpleTestCase):
                         [
                             'mainCellStyle/$ID/[None]', 'article1CellStyle/$ID/[None]'
                         ],
+                        # Only the styles used by the inserted elements are added.
                         [
                             'mainTableStyle/$ID/[No table style]',
                             'mainTableStyle/$ID/[Basic Table]',
-                            'article1TableStyle/$ID/[No table style]',
-                            'article1TableStyle/$ID/[Basic Table]'
                         ],
                         [
                             'mainObjectStyle/$ID/[None]',
@@ -2131,9 +2598,7 @@ class IdmlTestCase(SimpleTestCase):
                             'mainObjectStyle/$ID/[Normal Text Frame]',
                             'mainObjectStyle/$ID/[Normal Grid]',
                             'article1ObjectStyle/$ID/[None]',
-                            'article1ObjectStyle/$ID/[Normal Graphics Frame]',
                             'article1ObjectStyle/$ID/[Normal Text Frame]',
-                            'article1ObjectStyle/$ID/[Normal Grid]'
                         ]
                     ])
 
@@ -3494,11 +3959,10 @@ class IdmlTestCase(SimpleTestCase):
                         [
                             'mainCellStyle/$ID/[None]', 'article1CellStyle/$ID/[None]'
                         ],
+                        # Only the styles used by the inserted elements are added.
                         [
                             'mainTableStyle/$ID/[No table style]',
                             'mainTableStyle/$ID/[Basic Table]',
-                            'article1TableStyle/$ID/[No table style]',
-                            'article1TableStyle/$ID/[Basic Table]'
                         ],
                         [
                             'mainObjectStyle/$ID/[None]',
@@ -3506,9 +3970,7 @@ class IdmlTestCase(SimpleTestCase):
                             'mainObjectStyle/$ID/[Normal Text Frame]',
                             'mainObjectStyle/$ID/[Normal Grid]',
                             'article1ObjectStyle/$ID/[None]',
-                            'article1ObjectStyle/$ID/[Normal Graphics Frame]',
                             'article1ObjectStyle/$ID/[Normal Text Frame]',
-                            'article1ObjectStyle/$ID/[Normal Grid]'
                         ]
                     ])
 
@@ -3618,6 +4080,11 @@ class IdmlTestCase(SimpleTestCase):
                                                        only="/Root/page[1]") as new_idml:
                     self.assertEqual(len(new_idml.pages), 3)
 
+                    # The font families already there are not duplicated and only those used
+                    # by the page are added.
+                    self.assertEqual([f.get("Name") for f in new_idml.font_families],
+                                     ["Minion Pro", "Myriad Pro", "Kozuka Mincho Pro", "Gill Sans", "Helvetica"])
+
                     # The XML Structure has integrated the new file.
                     self.assertXMLEqual(str(new_idml.xml_structure_pretty().decode("utf-8")),
 """<Root Self="editodi2">
@@ -3714,6 +4181,36 @@ class IdmlTestCase(SimpleTestCase):
                                           'Spreads/Spread_magub6.xml',
                                           'Spreads/Spread_magub8.xml']))
 
+    def test_add_pages_from_idml_same_package(self):
+        magazineA_idml_filename = os.path.join(OUTPUT_DIR, "magazineA-template.idml")
+        bloc_notes_idml_filename = os.path.join(OUTPUT_DIR, "magazineA-bloc-notes.idml")
+        shutil.copy2(os.path.join(IDMLFILES_DIR, "magazineA-template.idml"), magazineA_idml_filename)
+        shutil.copy2(os.path.join(IDMLFILES_DIR, "magazineA-bloc-notes.idml"), bloc_notes_idml_filename)
+
+        with IDMLPackage(magazineA_idml_filename) as magazineA_idml_file,\
+            IDMLPackage(bloc_notes_idml_filename) as bloc_notes_idml_file:
+
+            with magazineA_idml_file.prefix("mag") as prefixed_mag,\
+                 bloc_notes_idml_file.prefix("blocnotes") as prefixed_bnotes:
+
+                packages_to_add = [
+                    (prefixed_bnotes, 1, "/Root", "/Root/page[1]"),
+                    (prefixed_bnotes, 2, "/Root", "/Root/page[2]"),
+                ]
+                # The resources of a package are merged once for all its pages.
+                with mock.patch.object(IDMLPackage, "_add_styles_from_idml", autospec=True,
+                                       side_effect=IDMLPackage._add_styles_from_idml) as add_styles:
+                    f = prefixed_mag.add_pages_from_idml(packages_to_add)
+                self.assertEqual(add_styles.call_count, 1)
+                with f:
+                    self.assertEqual(len(f.pages), 3)
+                    self.assertEqual([n.get("src") for n in f.designmap.spread_nodes],
+                                     ['Spreads/Spread_magub6.xml', 'Spreads/Spread_magub7.xml'])
+                    self.assertEqual(
+                        [e.get("Self") for e in f.xml_structure.iterchildren()],
+                        ["blocnotesdi2ib", "blocnotesdi2i10"]
+                    )
+
     def test_add_note(self):
         self.maxDiff = None
         shutil.copy2(os.path.join(IDMLFILES_DIR, "article-1photo_import-xml.idml"),
@@ -1,6 +1,9 @@
 # -*- coding: utf-8 -*-
 
+import io
 import unittest
+import zipfile
+import mock
 from lxml import etree
 
 
@@ -205,6 +208,27 @@ class UtilsTestCase(unittest.TestCase):
         self.assertEqual(foo.bark(), "Woof!")
         self.assertEqual(foo.crunch_those_numbers(2, 3), 5)
 
+    def test_copy_zip_member(self):
+        from simple_idml.utils import copy_zip_member
+        source_buffer, destination_buffer = io.BytesIO(), io.BytesIO()
+        with zipfile.ZipFile(source_buffer, mode="w") as source:
+            source.writestr("mimetype", "application/vnd.adobe.indesign-idml-package")
+            source.writestr("designmap.xml", "<Document/>" * 100, compress_type=zipfile.ZIP_DEFLATED)
+
+        with zipfile.ZipFile(source_buffer) as source,\
+             zipfile.ZipFile(destination_buffer, mode="w") as destination:
+            copy_zip_member(source, destination, source.getinfo("mimetype"))
+            # Without the private attributes of ZipFile, the member is read and written again.
+            with mock.patch("simple_idml.utils.hasattr", create=True, return_value=False):
+                copy_zip_member(source, destination, source.getinfo("designmap.xml"))
+
+        with zipfile.ZipFile(source_buffer) as source, zipfile.ZipFile(destination_buffer) as destination:
+            self.assertEqual(destination.namelist(), ["mimetype", "designmap.xml"])
+            self.assertEqual(destination.testzip(), None)
+            for name in source.namelist():
+                self.assertEqual(destination.read(name), source.read(name))
+                self.assertEqual(destination.getinfo(name).compress_type, source.getinfo(name).compress_type)
+
 
 def suite():
     suite = unittest.TestLoader().loadTestsFromTestCase(UtilsTestCase)